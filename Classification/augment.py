@@ -0,0 +1,137 @@
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class BatchAugment(nn.Module):
+    """
+    Batched version of the augmentation in utils.LetterBox (augment=True).
+
+    Takes the uint8 letterboxed batch produced by MyDataSet.collate_fn (gpu_augment mode)
+    together with the content box of every sample and applies, on the batch's device,
+    random horizontal / vertical flip, brightness (0.75, 1.5) and contrast (1.25, 1.75)
+    jitter in random order, random rotation within +-20 degrees and normalization.
+    Augmentation is restricted to the content box so the padding stays zero, like
+    augmenting before padding in the per-sample path.
+
+    Random parameters are drawn per sample on the cpu in the same order as the
+    torchvision transforms (flip, flip, ColorJitter, RandomRotation), so with the same
+    seed and num_workers=0 both paths pick the same parameters. Pixel values may still
+    differ slightly because PIL rounds to uint8 between every operation.
+
+    Args:
+        mean (list) - normalization mean per channel
+        std (list) - normalization std per channel
+        degrees (float) - max rotation angle
+        brightness (tuple) - brightness factor range
+        contrast (tuple) - contrast factor range
+    """
+
+    def __init__(self, mean, std, degrees=20., brightness=(0.75, 1.5), contrast=(1.25, 1.75)):
+        super(BatchAugment, self).__init__()
+        self.register_buffer("mean", torch.tensor(mean, dtype=torch.float32).view(1, -1, 1, 1))
+        self.register_buffer("std", torch.tensor(std, dtype=torch.float32).view(1, -1, 1, 1))
+        self.degrees = degrees
+        self.brightness = brightness
+        self.contrast = contrast
+
+    def sample_params(self, batch_size, generator=None):
+        hflip, vflip, brightness_first, brightness, contrast, angle = [], [], [], [], [], []
+        for _ in range(batch_size):
+            hflip.append(torch.rand(1, generator=generator).item() < 0.5)
+            vflip.append(torch.rand(1, generator=generator).item() < 0.5)
+            fn_idx = torch.randperm(4, generator=generator).tolist()
+            brightness.append(torch.empty(1).uniform_(*self.brightness, generator=generator).item())
+            contrast.append(torch.empty(1).uniform_(*self.contrast, generator=generator).item())
+            brightness_first.append(fn_idx.index(0) < fn_idx.index(1))
+            angle.append(torch.empty(1).uniform_(-self.degrees, self.degrees, generator=generator).item())
+        return {
+            "hflip": torch.tensor(hflip),
+            "vflip": torch.tensor(vflip),
+            "brightness_first": torch.tensor(brightness_first),
+            "brightness": torch.tensor(brightness),
+            "contrast": torch.tensor(contrast),
+            "angle": torch.tensor(angle),
+        }
+
+    @staticmethod
+    def _flip_index(size, start, length, flip):
+        # 只在内容区域[start, start+length)内翻转，padding部分保持不变
+        pos = torch.arange(size, device=start.device).view(1, -1)
+        start = start.view(-1, 1)
+        end = start + length.view(-1, 1)
+        inside = (pos >= start) & (pos < end) & flip.view(-1, 1)
+        return torch.where(inside, start + end - 1 - pos, pos)
+
+    def flip(self, x, boxes, hflip, vflip):
+        b, c, h, w = x.shape
+        x0, y0, bw, bh = boxes.unbind(1)
+        idx_w = self._flip_index(w, x0, bw, hflip).view(b, 1, 1, w).expand(b, c, h, w)
+        x = torch.gather(x, 3, idx_w)
+        idx_h = self._flip_index(h, y0, bh, vflip).view(b, 1, h, 1).expand(b, c, h, w)
+        return torch.gather(x, 2, idx_h)
+
+    @staticmethod
+    def content_mask(x, boxes):
+        b, _, h, w = x.shape
+        x0, y0, bw, bh = [v.view(-1, 1, 1, 1) for v in boxes.unbind(1)]
+        xs = torch.arange(w, device=x.device).view(1, 1, 1, w)
+        ys = torch.arange(h, device=x.device).view(1, 1, h, 1)
+        return ((xs >= x0) & (xs < x0 + bw) & (ys >= y0) & (ys < y0 + bh)).to(x.dtype)
+
+    def color_jitter(self, x, mask, brightness, contrast, brightness_first):
+        brightness = brightness.view(-1, 1, 1, 1)
+        contrast = contrast.view(-1, 1, 1, 1)
+
+        def adjust_brightness(img):
+            return (img * brightness).clamp(0, 1)
+
+        def adjust_contrast(img):
+            if img.shape[1] == 3:
+                gray = (0.299 * img[:, 0] + 0.587 * img[:, 1] + 0.114 * img[:, 2]).unsqueeze(1)
+            else:
+                gray = img
+            # 灰度均值只统计内容区域
+            mean = (gray * mask).sum((1, 2, 3), keepdim=True) / mask.sum((1, 2, 3), keepdim=True).clamp(min=1)
+            return (contrast * img + (1 - contrast) * mean).clamp(0, 1)
+
+        first = adjust_contrast(adjust_brightness(x))
+        second = adjust_brightness(adjust_contrast(x))
+        return torch.where(brightness_first.view(-1, 1, 1, 1), first, second) * mask
+
+    def rotate(self, x, boxes, angle):
+        b, _, h, w = x.shape
+        x0, y0, bw, bh = boxes.to(x.dtype).unbind(1)
+        # 以内容区域中心为旋转中心（与PIL.Image.rotate一致），坐标归一化到[-1, 1]
+        cx = 2 * (x0 + bw / 2) / w - 1
+        cy = 2 * (y0 + bh / 2) / h - 1
+        rad = angle.to(x.dtype) * math.pi / 180
+        cos, sin = torch.cos(rad), torch.sin(rad)
+        theta = torch.stack([
+            torch.stack([cos, -sin, cx - (cos * cx - sin * cy)], dim=1),
+            torch.stack([sin, cos, cy - (sin * cx + cos * cy)], dim=1),
+        ], dim=1)
+        grid = F.affine_grid(theta, list(x.shape), align_corners=False)
+        return F.grid_sample(x, grid, mode="nearest", padding_mode="zeros", align_corners=False)
+
+    def normalize(self, x):
+        return (x - self.mean) / self.std
+
+    @torch.no_grad()
+    def forward(self, images, boxes, params=None):
+        x = images.float().div_(255)
+        if not self.training:
+            return self.normalize(x)
+
+        if params is None:
+            params = self.sample_params(x.shape[0])
+        params = {k: v.to(x.device) for k, v in params.items()}
+        boxes = boxes.to(x.device)
+
+        x = self.flip(x, boxes, params["hflip"], params["vflip"])
+        mask = self.content_mask(x, boxes)
+        x = self.color_jitter(x, mask, params["brightness"], params["contrast"], params["brightness_first"])
+        x = self.rotate(x, boxes, params["angle"]) * mask
+        return self.normalize(x)
@@ -0,0 +1,175 @@
+import time
+import argparse
+
+import torch
+import numpy as np
+from PIL import Image
+from torchvision import transforms
+
+from utils import LetterBox
+from model.model_zoo import model_dict
+from model.fuse import fuse_for_inference
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('SAC micro benchmarks', add_help=False)
+    parser.add_argument('--bench', type=str, default='letterbox')
+    parser.add_argument('--img_channel', type=int, default=1)
+    parser.add_argument('--num_images', type=int, default=500)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--model_config', type=str, default='ResNet50,DenseNet121,EfficientNetV2_s', help='comma separated model_zoo names')
+    parser.add_argument('--device', default='cuda:0', help='device id (i.e. 0 or 0,1 or cpu)')
+
+    return parser
+
+
+def reference_resize_and_pad(image, target_size, mean, std, img_channel):
+    # resize_and_pad的原始实现：每张图构造两个Compose，几何尺寸计算两次
+    width, height = image.size
+    if width > height:
+        new_width = target_size
+        new_height = int(height * (target_size / width))
+    else:
+        new_height = target_size
+        new_width = int(width * (target_size / height))
+    image = transforms.Compose([transforms.Resize((new_height, new_width))])(image)
+
+    width, height = image.size
+    if width > height:
+        new_width = target_size
+        new_height = int(height * (target_size / width))
+    else:
+        new_height = target_size
+        new_width = int(width * (target_size / height))
+    pad_height1 = (target_size - new_width) // 2
+    pad_height2 = target_size - new_width - pad_height1
+    pad_width1 = (target_size - new_height) // 2
+    pad_width2 = target_size - new_height - pad_width1
+
+    transform = transforms.Compose([
+        transforms.Pad((pad_height1, pad_width1, pad_height2, pad_width2), fill=(0,)*img_channel),
+        transforms.ToTensor(),
+        transforms.Normalize(mean, std)
+    ])
+    return transform(image)
+
+
+def random_images(num_images, img_channel):
+    rng = np.random.default_rng(0)
+    images = []
+    for _ in range(num_images):
+        h, w = rng.integers(60, 400, size=2)
+        shape = (h, w) if img_channel == 1 else (h, w, 3)
+        images.append(Image.fromarray(rng.integers(0, 256, size=shape, dtype=np.uint8)))
+    return images
+
+
+def timeit(fn, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_letterbox(args):
+    if args.img_channel == 3 :
+        mean, std = [0.485, 0.456, 0.406], [0.229, 0.224, 0.225]
+    else :
+        mean, std = [0.5], [0.5]
+    images = random_images(args.num_images, args.img_channel)
+    letterbox = LetterBox(224, mean, std)
+
+    for img in images:
+        assert torch.equal(reference_resize_and_pad(img, 224, mean, std, args.img_channel), letterbox(img))
+
+    out = torch.empty((args.img_channel, 224, 224))
+    batches = [images[i:i + args.batch_size] for i in range(0, len(images), args.batch_size)]
+    results = {
+        "reference": timeit(lambda: [reference_resize_and_pad(img, 224, mean, std, args.img_channel) for img in images]),
+        "letterbox": timeit(lambda: [letterbox(img) for img in images]),
+        "letterbox (out=)": timeit(lambda: [letterbox(img, out=out) for img in images]),
+        "letterbox.batch": timeit(lambda: [letterbox.batch(batch) for batch in batches]),
+    }
+    for name, seconds in results.items():
+        print("{:<20s} {:8.1f} us/image  x{:.2f}".format(
+            name, seconds / len(images) * 1e6, results["reference"] / seconds))
+
+
+def randomize_bn(model, seed=0):
+    # 随机初始化BN的统计量和仿射参数，否则融合前后几乎没有差别
+    generator = torch.Generator().manual_seed(seed)
+    for m in model.modules():
+        if isinstance(m, torch.nn.BatchNorm2d):
+            c = m.num_features
+            m.running_mean.copy_(torch.randn(c, generator=generator) * 0.1)
+            m.running_var.copy_(torch.rand(c, generator=generator) + 0.5)
+            m.weight.data.copy_(torch.rand(c, generator=generator) + 0.5)
+            m.bias.data.copy_(torch.randn(c, generator=generator) * 0.1)
+
+
+def time_model(model, images, repeat=10):
+    def run():
+        with torch.no_grad():
+            model(images)
+        if images.is_cuda:
+            torch.cuda.synchronize(images.device)
+    run()
+    return timeit(run, repeat)
+
+
+def bench_fuse(args):
+    device = torch.device(args.device if torch.cuda.is_available() else "cpu")
+    images = torch.randn((args.batch_size, args.img_channel, 224, 224), device=device)
+    for name in args.model_config.split(","):
+        model = model_dict[name](in_channels=args.img_channel, num_classes=2)
+        randomize_bn(model)
+        model = model.to(device).eval()
+        with torch.no_grad():
+            reference = model(images)
+        unfused = time_model(model, images)
+
+        model = fuse_for_inference(model)
+        with torch.no_grad():
+            fused = model(images)
+        diff = (fused - reference).abs().max().item()
+        seconds = time_model(model, images)
+        print("{:<20s} max |logit diff| {:.2e}  {:8.2f} ms -> {:8.2f} ms  x{:.2f}".format(
+            name, diff, unfused * 1e3, seconds * 1e3, unfused / seconds))
+        assert torch.allclose(fused, reference, rtol=1e-3, atol=1e-3), name
+
+
+def bench_convnext(args):
+    # 同一组权重：默认NCHW实现 / channels_last实现 / channels_last + torch.compile
+    device = torch.device(args.device if torch.cuda.is_available() else "cpu")
+    images = torch.randn((args.batch_size, args.img_channel, 224, 224), device=device)
+    names = [name for name in args.model_config.split(",") if name.startswith("ConvNeXt")] or ["ConvNeXt_tiny"]
+    for name in names:
+        model = model_dict[name](in_channels=args.img_channel, num_classes=2).to(device).eval()
+        variant = model_dict[name](in_channels=args.img_channel, num_classes=2, channels_last=True).to(device).eval()
+        variant.load_state_dict(model.state_dict())
+        with torch.no_grad():
+            reference = model(images)
+            output = variant(images)
+        diff = (output - reference).abs().max().item()
+        assert torch.allclose(output, reference, rtol=1e-3, atol=1e-3), name
+
+        results = {"channels_first": time_model(model, images), "channels_last": time_model(variant, images)}
+        if hasattr(torch, "compile"):
+            results["channels_last+compile"] = time_model(torch.compile(variant), images)
+        print("{:<20s} max |logit diff| {:.2e}".format(name, diff))
+        for key, seconds in results.items():
+            print("    {:<22s} {:8.2f} ms  {:8.1f} images/s  x{:.2f}".format(
+                key, seconds * 1e3, len(images) / seconds, results["channels_first"] / seconds))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('SAC micro benchmarks', parents=[get_args_parser()])
+    args = parser.parse_args()
+    benches = {
+        "letterbox": bench_letterbox,
+        "fuse": bench_fuse,
+        "convnext": bench_convnext,
+    }
+    benches[args.bench](args)
@@ -0,0 +1,173 @@
+import os
+import json
+import uuid
+from contextlib import contextmanager
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+
+def aspect_size(width, height, target_size):
+    # 长边缩放到target_size，短边按比例缩放（与LetterBox保持一致）
+    if width > height:
+        return target_size, int(height * (target_size / width))
+    else:
+        return int(width * (target_size / height)), target_size
+
+
+class ImageCache:
+    """
+    Pre-decoded image cache stored in one memory-mapped uint8 file.
+
+    Every image is decoded once, converted to 'L' or 'RGB' and resized so its longer
+    side equals target_size, then appended to the data file `images.<build>.bin`.
+    `index.json` names the data file and keeps the byte offset and shape of every entry
+    together with the source file mtime and size, the cache is rebuilt automatically
+    when any of them (or target_size / channels) change. Entries are returned as
+    read-only views of the memory map.
+
+    Several processes (parallel folds, predict.py during training) may share a cache
+    directory: checking and rebuilding happen under a file lock, both files are written
+    to per-process temporary names and moved into place, and every build writes a new
+    data file, so an index is never paired with another build's data. The data files of
+    older builds are removed on the next rebuild.
+
+    Args:
+        cache_dir (str) - directory holding the data files and index.json
+        images_path (list) - image files that must be available in the cache
+        target_size (int) - size of the longer side after resizing, 0 keeps the original size
+        channels (int) - 1 for grayscale, 3 for RGB
+    """
+
+    def __init__(self, cache_dir: str, images_path: list, target_size: int = 224, channels: int = 1):
+        self.cache_dir = cache_dir
+        self.target_size = target_size
+        self.channels = channels
+        self.index_file = os.path.join(cache_dir, "index.json")
+        self._data = None
+
+        os.makedirs(cache_dir, exist_ok=True)
+        with self._lock():
+            index = self._load_index()
+            if index is None or not self._is_fresh(index, images_path):
+                index = self._build(images_path, index)
+        self.data_file = os.path.join(cache_dir, index["data_file"])
+        self.entries = index["entries"]
+
+    @contextmanager
+    def _lock(self):
+        # 多个进程共用同一个缓存目录时，检查和重建互斥
+        try:
+            import fcntl
+        except ImportError:
+            yield
+            return
+        with open(os.path.join(self.cache_dir, ".lock"), "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _stat(path):
+        st = os.stat(path)
+        return st.st_mtime_ns, st.st_size
+
+    def _load_index(self):
+        if not os.path.exists(self.index_file):
+            return None
+        with open(self.index_file, "r") as f:
+            index = json.load(f)
+        if "data_file" not in index or not os.path.exists(os.path.join(self.cache_dir, index["data_file"])):
+            return None
+        if index.get("target_size") != self.target_size or index.get("channels") != self.channels:
+            return None
+        return index
+
+    def _is_fresh(self, index, images_path):
+        entries = index["entries"]
+        for path in images_path:
+            key = os.path.abspath(path)
+            if key not in entries:
+                return False
+            mtime, size = self._stat(path)
+            if entries[key]["mtime"] != mtime or entries[key]["size"] != size:
+                return False
+        return True
+
+    def _build(self, images_path, old_index=None):
+        # 保留旧索引中仍然存在的文件，避免不同fold之间反复重建
+        paths = {os.path.abspath(p) for p in images_path}
+        if old_index is not None:
+            paths.update(p for p in old_index["entries"] if os.path.exists(p))
+        paths = sorted(paths)
+
+        mode = "L" if self.channels == 1 else "RGB"
+        entries = {}
+        offset = 0
+        data_name = "images.{}.bin".format(uuid.uuid4().hex)
+        data_file = os.path.join(self.cache_dir, data_name)
+        tmp_file = "{}.{}.tmp".format(data_file, os.getpid())
+        with open(tmp_file, "wb") as f:
+            for path in tqdm(paths, desc="building image cache"):
+                img = Image.open(path).convert(mode)
+                new_width, new_height = img.width, img.height
+                if self.target_size > 0:
+                    new_width, new_height = aspect_size(img.width, img.height, self.target_size)
+                    img = img.resize((new_width, new_height), Image.BILINEAR)
+                arr = np.asarray(img, dtype=np.uint8).reshape(new_height, new_width, self.channels)
+                f.write(arr.tobytes())
+                mtime, size = self._stat(path)
+                entries[path] = {
+                    "offset": offset,
+                    "shape": [new_height, new_width, self.channels],
+                    "mtime": mtime,
+                    "size": size,
+                }
+                offset += arr.nbytes
+        os.replace(tmp_file, data_file)
+
+        index = {"target_size": self.target_size, "channels": self.channels, "data_file": data_name, "entries": entries}
+        tmp_file = "{}.{}.tmp".format(self.index_file, os.getpid())
+        with open(tmp_file, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_file, self.index_file)
+
+        # 删除更早的数据文件；上一次构建的文件保留给仍在读取它的进程
+        keep = {data_name, old_index["data_file"] if old_index is not None else None}
+        for item in os.scandir(self.cache_dir):
+            if item.name.startswith("images.") and item.name.endswith(".bin") and item.name not in keep:
+                os.remove(item.path)
+        return index
+
+    def __getstate__(self):
+        # DataLoader的worker进程各自重新打开memmap
+        state = self.__dict__.copy()
+        state["_data"] = None
+        return state
+
+    @property
+    def data(self):
+        if self._data is None:
+            if os.path.getsize(self.data_file) == 0:
+                self._data = np.zeros(0, dtype=np.uint8)
+            else:
+                self._data = np.memmap(self.data_file, dtype=np.uint8, mode="r")
+        return self._data
+
+    def __contains__(self, path):
+        return os.path.abspath(path) in self.entries
+
+    def get_array(self, path):
+        entry = self.entries[os.path.abspath(path)]
+        h, w, c = entry["shape"]
+        offset = entry["offset"]
+        return self.data[offset:offset + h * w * c].reshape(h, w, c)
+
+    def get_image(self, path):
+        arr = self.get_array(path)
+        if self.channels == 1:
+            arr = arr[:, :, 0]
+        return Image.fromarray(arr)
@@ -1,36 +1,250 @@
+import io
+import os
+import json
+import random
+import tarfile
 from PIL import Image
 import torch
 from torchvision import transforms
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
 import matplotlib.pyplot as plt
 import torchvision.transforms.functional as F
-from utils import augment_and_pad
+from utils import LetterBox
 
 class MyDataSet(Dataset):
 
-    def __init__(self, images_path: list, images_class: list, is_train: bool, mean, std):
+    def __init__(self, images_path: list, images_class: list, is_train: bool, mean, std, cache=None, gpu_augment=False, augment=None):
         self.images_path = images_path
         self.images_class = images_class
         self.mean = mean
         self.std = std
         self.channels = len(mean)
+        # 可选的预解码缓存（cache.ImageCache），命中时不再打开原始jpg
+        self.cache = cache
+        # gpu_augment模式下只返回letterbox后的uint8图像，增强和归一化由augment.BatchAugment在训练设备上完成
+        self.gpu_augment = gpu_augment
+        self.letterbox = LetterBox(224, mean, std)
+        # augment默认跟随is_train：验证集与gpu_augment模式（BatchAugment.eval）一样不做随机增强
+        # augment=False时等价于原来的resize_and_pad，用于测试集推理
+        self.augment = is_train if augment is None else augment
 
     def __len__(self):
         return len(self.images_path)
 
-    def __getitem__(self, item):
+    def load_image(self, item):
+        if self.cache is not None and self.images_path[item] in self.cache:
+            return self.cache.get_image(self.images_path[item])
         img = Image.open(self.images_path[item])
         if self.channels == 1 :
             img = img.convert('L')
-        
-        img = augment_and_pad(img, 224, self.mean, self.std, self.channels)
+        return img
+
+    def __getitem__(self, item):
+        img = self.load_image(item)
         label = self.images_class[item]
 
+        if self.gpu_augment:
+            img, box = self.letterbox.to_uint8(img)
+            return img, label, box
+
+        img = self.letterbox(img, augment=self.augment)
+
         return img, label
 
     @staticmethod
     def collate_fn(batch):
+        if len(batch[0]) == 3:
+            images, labels, boxes = tuple(zip(*batch))
+            return torch.stack(images, dim=0), torch.as_tensor(labels), torch.stack(boxes, dim=0)
         images, labels = tuple(zip(*batch))
         images = torch.stack(images, dim=0)
         labels = torch.as_tensor(labels)
         return images, labels
+
+
+class ROIDataSet(MyDataSet):
+    """
+    Crops ROIs from the full labelme images on the fly.
+
+    Reads the <split>_rois.json files written by data/make_task*_classification.py with
+    save_crops=False. Every ROI yields 1 + aug_size samples per epoch, the exact box and
+    aug_size jittered boxes with a fresh random displacement each time (the offline
+    scripts store a fixed set of _aug crops instead). Displacements and clamping follow
+    the offline scripts. The full images are decoded once into `cache` when given
+    (cache.ImageCache with target_size=0).
+
+    Args:
+        roi_dir (str) - directory with the <split>_rois.json files, class indices come from
+            its class_indices.json (written on first use from the labels of all splits)
+        splits (list) - splits to read, e.g. ["train", "val"]
+        is_train (bool) - jitter boxes, False always returns the exact box
+    """
+
+    def __init__(self, roi_dir: str, splits: list, is_train: bool, mean, std, cache=None, gpu_augment=False, augment=None):
+        self.rois = []
+        for split in splits:
+            with open(os.path.join(roi_dir, f"{split}_rois.json"), "r") as f:
+                self.rois += json.load(f)
+        class_indices = self.read_class_indices(roi_dir)
+
+        # 每个ROI展开为 (roi, k)，k=0为原始框，k>=1为随机位移框，每个epoch样本数与离线增强一致
+        self.samples = []
+        for i, roi in enumerate(self.rois):
+            aug_size = roi["aug_size"] if is_train else 0
+            self.samples += [(i, k) for k in range(aug_size + 1)]
+        images_path = [self.rois[i]["image"] for i, _ in self.samples]
+        images_class = [class_indices[self.rois[i]["label"]] for i, _ in self.samples]
+        super().__init__(images_path, images_class, is_train, mean, std, cache, gpu_augment, augment)
+        print("{} ROIs ({} samples) for {}.".format(len(self.rois), len(self.samples), ", ".join(splits)))
+
+    @staticmethod
+    def read_class_indices(roi_dir):
+        # 类别索引与read_dataset一致：优先读class_indices.json，否则取所有split的类别名排序，
+        # 保证只读val / test时与train的索引相同
+        json_path = os.path.join(roi_dir, 'class_indices.json')
+        if os.path.exists(json_path):
+            with open(json_path, "r") as f:
+                return dict((name, int(idx)) for idx, name in json.load(f).items())
+        classes = set()
+        for name in os.listdir(roi_dir):
+            if name.endswith("_rois.json"):
+                with open(os.path.join(roi_dir, name), "r") as f:
+                    classes.update(roi["label"] for roi in json.load(f))
+        class_indices = dict((k, v) for v, k in enumerate(sorted(classes)))
+        with open(json_path + '.{}.tmp'.format(os.getpid()), 'w') as f:
+            json.dump(dict((val, key) for key, val in class_indices.items()), f, indent=4)
+        os.replace(json_path + '.{}.tmp'.format(os.getpid()), json_path)
+        return class_indices
+
+    @staticmethod
+    def displacement(delta, k):
+        # 与离线脚本相同：打乱range(-delta, delta)，最小边取第k个、最大边取第-k个（k=0时为平移）
+        if delta <= 0 :
+            return 0, 0
+        displacement = list(range(-delta, delta))
+        random.shuffle(displacement)
+        return displacement[k], displacement[-k]
+
+    @staticmethod
+    def jitter(box, delta, k, width, height):
+        # k为离线脚本中第k个增强框（0 ~ aug_size-1）
+        x_min, y_min, x_max, y_max = box
+        x_delta, y_delta = delta
+        dx = ROIDataSet.displacement(x_delta, k)
+        dy = ROIDataSet.displacement(y_delta, k)
+        xx_min = x_min + dx[0]
+        yy_min = y_min + dy[0]
+        xx_max = x_max + dx[1]
+        yy_max = y_max + dy[1]
+        # 与离线脚本相同的边界处理
+        if xx_min < 0 :
+            xx_min = 0
+        if yy_min < 0 :
+            yy_min = 0
+        if xx_min >= height :
+            xx_min = height-1
+        if yy_min >= width :
+            yy_min = width-1
+        return xx_min, yy_min, xx_max, yy_max
+
+    def load_image(self, item):
+        img = super().load_image(item)
+        roi = self.rois[self.samples[item][0]]
+        box = roi["box"]
+        k = self.samples[item][1]
+        if k > 0 :
+            box = self.jitter(box, roi["delta"], k - 1, img.width, img.height)
+        return img.crop(tuple(box))
+
+
+class ShardDataSet(IterableDataset):
+    """
+    Streaming dataset over tar shards written by data/pack_shards.py.
+
+    Shards are read sequentially in large chunks, split between DataLoader workers, and
+    samples are shuffled through a buffer of `shuffle_buffer` images (plus shard order
+    shuffling) when is_train is set. Samples are preprocessed exactly like MyDataSet.
+
+    Args:
+        shard_dir (str) - directory with <split>.json indexes and the .tar shards
+        splits (list) - splits to read, e.g. ["fold2", "fold3", "fold4", "fold5"]
+        is_train (bool) - shuffle shards and samples
+        shuffle_buffer (int) - number of decoded samples kept for shuffling
+        read_size (int) - buffer size used for reading shard files
+    """
+
+    def __init__(self, shard_dir: str, splits: list, is_train: bool, mean, std, gpu_augment=False, augment=None,
+                 shuffle_buffer=1000, read_size=8 * 1024 * 1024):
+        self.shard_dir = shard_dir
+        self.is_train = is_train
+        self.channels = len(mean)
+        self.gpu_augment = gpu_augment
+        self.augment = is_train if augment is None else augment
+        self.letterbox = LetterBox(224, mean, std)
+        self.shuffle_buffer = shuffle_buffer
+        self.read_size = read_size
+
+        self.shards = []
+        self.shard_labels = {}
+        self.images_class = []
+        for split in splits:
+            with open(os.path.join(shard_dir, f"{split}.json"), "r") as f:
+                index = json.load(f)
+            for shard in index["shards"]:
+                self.shards.append(shard["file"])
+                self.shard_labels[shard["file"]] = dict((name, label) for name, label in shard["samples"])
+                self.images_class += [label for _, label in shard["samples"]]
+        print("{} images in {} shards for {}.".format(len(self.images_class), len(self.shards), ", ".join(splits)))
+
+    def __len__(self):
+        return len(self.images_class)
+
+    def process(self, data, label):
+        img = Image.open(io.BytesIO(data))
+        img = img.convert('L') if self.channels == 1 else img.convert('RGB')
+        if self.gpu_augment:
+            img, box = self.letterbox.to_uint8(img)
+            return img, label, box
+        return self.letterbox(img, augment=self.augment), label
+
+    def read_shard(self, shard):
+        labels = self.shard_labels[shard]
+        with open(os.path.join(self.shard_dir, shard), "rb", buffering=self.read_size) as f:
+            with tarfile.open(fileobj=f, mode="r|") as tar:
+                for member in tar:
+                    if member.isfile():
+                        yield tar.extractfile(member).read(), labels[member.name]
+
+    def __iter__(self):
+        # shard顺序必须在所有worker之间一致，否则划分后有的shard被重复读取、有的没有被读取：
+        # worker的seed为 base_seed + worker id，base_seed每个epoch由主进程重新生成
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            epoch_seed = worker_info.seed - worker_info.id
+            rng = random.Random(worker_info.seed)
+        else:
+            epoch_seed = int(torch.empty((), dtype=torch.int64).random_().item())
+            rng = random.Random(epoch_seed)
+        shards = list(self.shards)
+        if self.is_train:
+            random.Random(epoch_seed).shuffle(shards)
+        if worker_info is not None:
+            shards = shards[worker_info.id::worker_info.num_workers]
+
+        buffer = []
+        for shard in shards:
+            for data, label in self.read_shard(shard):
+                if not self.is_train:
+                    yield self.process(data, label)
+                    continue
+                if len(buffer) < self.shuffle_buffer:
+                    buffer.append((data, label))
+                    continue
+                idx = rng.randrange(len(buffer))
+                buffer[idx], (data, label) = (data, label), buffer[idx]
+                yield self.process(data, label)
+        rng.shuffle(buffer)
+        for data, label in buffer:
+            yield self.process(data, label)
+
+    collate_fn = staticmethod(MyDataSet.collate_fn)
@@ -1,41 +1,129 @@
 import sys
+import time
 import torch
 from tqdm import tqdm
 
 
-def train_one_epoch(model, optimizer, data_loader, device, epoch, lr_scheduler):
+def get_amp_dtype(device):
+    # cuda上使用fp16 + GradScaler，cpu上使用bf16 autocast（不需要GradScaler）
+    return torch.float16 if device.type == "cuda" else torch.bfloat16
+
+
+def to_device(images, device, channels_last=False):
+    if channels_last and images.dim() == 4:
+        return images.to(device, non_blocking=True, memory_format=torch.channels_last)
+    return images.to(device, non_blocking=True)
+
+
+class LogTimer:
+    """
+    Decides when to refresh the progress bar: every `interval` steps, after `seconds`
+    seconds, and on the last step. Reading the device-side metrics forces a sync, so
+    they are only fetched on these steps.
+    """
+    def __init__(self, num_steps, interval=20, seconds=2.0):
+        self.num_steps = num_steps
+        self.interval = interval
+        self.seconds = seconds
+        self.last_time = time.time()
+
+    def __call__(self, step):
+        now = time.time()
+        if (step + 1) % self.interval == 0 or now - self.last_time > self.seconds or step + 1 == self.num_steps:
+            self.last_time = now
+            return True
+        return False
+
+
+def mark_last(iterable):
+    # 提前取下一个元素来判断当前元素是否是最后一个；IterableDataset（ShardDataSet）的batch数
+    # 会因每个worker末尾不满的batch而多于len(data_loader)，不能按len判断epoch结束
+    iterator = iter(iterable)
+    item = next(iterator, None)
+    while item is not None:
+        next_item = next(iterator, None)
+        yield item, next_item is None
+        item = next_item
+
+
+def train_one_epoch(model, optimizer, data_loader, device, epoch, lr_scheduler, batch_augment=None,
+                    amp_dtype=None, scaler=None, channels_last=False, log_interval=20, log_seconds=2.0,
+                    accum_steps=1):
     model.train()
+    if batch_augment is not None:
+        batch_augment.train()
     loss_function = torch.nn.CrossEntropyLoss()
     accu_loss = torch.zeros(1).to(device)
     accu_num = torch.zeros(1).to(device)
+    nonfinite_num = torch.zeros(1).to(device)
+    first_nonfinite = torch.zeros(1).to(device)
     optimizer.zero_grad()
 
     sample_num = 0
+    num_steps = len(data_loader)
+    log_timer = LogTimer(num_steps, log_interval, log_seconds)
     data_loader = tqdm(data_loader, file=sys.stdout)
-    for step, data in enumerate(data_loader):
-        images, labels = data
+    group_count = 0
+    for step, (data, is_last) in enumerate(mark_last(data_loader)):
+        images, labels = data[0], data[1]
         sample_num += images.shape[0]
-
-        pred = model(images.to(device))
+        if batch_augment is not None:
+            images = batch_augment(images.to(device, non_blocking=True), data[2])
+        images = to_device(images, device, channels_last)
+        labels = labels.to(device, non_blocking=True)
+
+        # 梯度累积：每accum_steps个micro-batch更新一次参数，epoch末尾不足accum_steps的一组
+        # 在更新前把梯度重新按实际大小归一化
+        group_count += 1
+        is_update_step = group_count == accum_steps or is_last
+
+        with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+            pred = model(images)
+            loss = loss_function(pred, labels)
         pred_classes = torch.max(pred, dim=1)[1]
-        accu_num += torch.eq(pred_classes, labels.to(device)).sum()
+        accu_num += torch.eq(pred_classes, labels).sum()
 
-        loss = loss_function(pred, labels.to(device))
-        loss.backward()
+        if scaler is not None:
+            scaler.scale(loss / accum_steps).backward()
+        else:
+            (loss / accum_steps).backward()
         accu_loss += loss.detach()
-
-        data_loader.desc = "[train epoch {}] loss: {:.4f}, acc: {:.4f}, lr: {:.5f}".format(
-            epoch,
-            accu_loss.item() / (step + 1),
-            accu_num.item() / sample_num,
-            optimizer.param_groups[0]["lr"]
-        )
-
-        if not torch.isfinite(loss):
-            print('WARNING: non-finite loss, ending training ', loss)
-            sys.exit(1)
-
-        optimizer.step()
+        # 检查的是未缩放的loss；梯度溢出由GradScaler跳过该步处理
+        # 在device上计数，并记录第一个non-finite的loss值
+        nonfinite = ~torch.isfinite(loss.detach())
+        first_nonfinite = torch.where(nonfinite & (nonfinite_num == 0), loss.detach(), first_nonfinite)
+        nonfinite_num += nonfinite.float()
+
+        if log_timer(step) or is_last:
+            # 一次同步同时取回loss、acc和non-finite计数；权重只在epoch结束后保存，
+            # 在这里退出时non-finite的更新不会被写入checkpoint
+            loss_sum, num_sum, nonfinite_sum, first_value = torch.cat(
+                [accu_loss, accu_num, nonfinite_num, first_nonfinite]).tolist()
+            data_loader.desc = "[train epoch {}] loss: {:.4f}, acc: {:.4f}, lr: {:.5f}".format(
+                epoch,
+                loss_sum / (step + 1),
+                num_sum / sample_num,
+                optimizer.param_groups[0]["lr"]
+            )
+
+            if nonfinite_sum > 0:
+                print('WARNING: non-finite loss, ending training ', first_value)
+                sys.exit(1)
+
+        if not is_update_step:
+            continue
+
+        if group_count < accum_steps:
+            for group in optimizer.param_groups:
+                for p in group["params"]:
+                    if p.grad is not None:
+                        p.grad.mul_(accum_steps / group_count)
+        group_count = 0
+        if scaler is not None:
+            scaler.step(optimizer)
+            scaler.update()
+        else:
+            optimizer.step()
         optimizer.zero_grad()
         lr_scheduler.step()
 
@@ -43,31 +131,42 @@ def train_one_epoch(model, optimizer, data_loader, device, epoch, lr_scheduler):
 
 
 @torch.no_grad()
-def evaluate(model, data_loader, device, epoch):
+def evaluate(model, data_loader, device, epoch, batch_augment=None, amp_dtype=None, channels_last=False,
+             log_interval=20, log_seconds=2.0):
     loss_function = torch.nn.CrossEntropyLoss()
 
     model.eval()
+    if batch_augment is not None:
+        batch_augment.eval()
 
     accu_num = torch.zeros(1).to(device)
     accu_loss = torch.zeros(1).to(device)
 
     sample_num = 0
+    log_timer = LogTimer(len(data_loader), log_interval, log_seconds)
     data_loader = tqdm(data_loader, file=sys.stdout)
     for step, data in enumerate(data_loader):
-        images, labels = data
+        images, labels = data[0], data[1]
         sample_num += images.shape[0]
-
-        pred = model(images.to(device))
+        if batch_augment is not None:
+            images = batch_augment(images.to(device, non_blocking=True), data[2])
+        images = to_device(images, device, channels_last)
+        labels = labels.to(device, non_blocking=True)
+
+        with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+            pred = model(images)
+            loss = loss_function(pred, labels)
         pred_classes = torch.max(pred, dim=1)[1]
-        accu_num += torch.eq(pred_classes, labels.to(device)).sum()
+        accu_num += torch.eq(pred_classes, labels).sum()
 
-        loss = loss_function(pred, labels.to(device))
         accu_loss += loss
 
-        data_loader.desc = "[valid epoch {}] loss: {:.4f}, acc: {:.4f}".format(
-            epoch,
-            accu_loss.item() / (step + 1),
-            accu_num.item() / sample_num
-        )
+        if log_timer(step):
+            loss_sum, num_sum = torch.cat([accu_loss, accu_num]).tolist()
+            data_loader.desc = "[valid epoch {}] loss: {:.4f}, acc: {:.4f}".format(
+                epoch,
+                loss_sum / (step + 1),
+                num_sum / sample_num
+            )
 
     return accu_loss.item() / (step + 1), accu_num.item() / sample_num
@@ -0,0 +1,170 @@
+import os
+import json
+import argparse
+
+import torch
+import torch.nn as nn
+
+from model.model_zoo import model_dict
+from model.fuse import fuse_for_inference
+
+CONFIG_FILE = "config.json"
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('SAC model export for image classification', add_help=False)
+    parser.add_argument('--num_classes', type=int, default=2)
+    parser.add_argument('--task', type=str, default="Task3_final")
+    parser.add_argument('--img_channel', type=int, default=1)
+    parser.add_argument('--fold', type=int, default=0)
+    parser.add_argument('--checkpoint', type=str, default='last', help='best or last')
+    parser.add_argument('--format', type=str, default='torchscript', help='torchscript (.ts) or export (torch.export, .pt2)')
+    parser.add_argument('--fuse', type=bool, default=False, help='fold BatchNorm into convolutions before exporting')
+    parser.add_argument('--batch_size', type=int, default=2, help='batch size of the example input')
+    parser.add_argument('--max_batch', type=int, default=1024, help='torch.export: upper bound of the dynamic batch dimension')
+    parser.add_argument('--output', type=str, default='', help='artifact path, defaults to <weights_dir>/fold<fold>_<checkpoint>.ts / .pt2')
+    parser.add_argument('--weights_dir', type=str, default='weights')
+    parser.add_argument('--model_config', type=str, default='DenseNet169')
+    parser.add_argument('--device', default='cuda:0', help='device id (i.e. 0 or 0,1 or cpu)')
+
+    return parser
+
+
+def get_normalization(img_channel):
+    if img_channel == 3 :
+        return [0.485, 0.456, 0.406], [0.229, 0.224, 0.225]
+    return [0.5], [0.5]
+
+
+def build_model(model_config, img_channel, num_classes, weight_path, device, fuse=False):
+    """
+    Build a model_dict entry and load a checkpoint saved by train.py, in eval mode.
+
+    Training-only options (DenseNet memory_efficient / shared_buffer, checkpoint_segments)
+    do not change the state dict and are left at their defaults (off).
+
+    Args:
+        model_config (str) - model_dict name
+        img_channel (int) - input channels
+        num_classes (int) - output classes
+        weight_path (str) - fold<k>_best.pth / fold<k>_last.pth
+        device (torch.device) - device the model is moved to
+        fuse (bool) - fold BatchNorm into convolutions, see model.fuse
+    """
+    model = model_dict[model_config](in_channels=img_channel, num_classes=num_classes).to(device)
+    model.load_state_dict(torch.load(weight_path, map_location=device))
+    model.eval()
+    if fuse :
+        model = fuse_for_inference(model)
+    return model
+
+
+def export_torchscript(model, example, path, config):
+    """
+    Trace the model into a frozen TorchScript module.
+
+    The model comes from build_model, which creates it with the model_dict defaults:
+    DenseNet's memory_efficient / shared_buffer modes and activation checkpointing are
+    off whatever the training run used, and tracing in eval mode skips drop path, so
+    every model_dict entry can be exported. The trace is checked on a batch of a
+    different size, the batch dimension stays free. The config is stored as an extra file.
+    """
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example, check_inputs=[(example[:1],)])
+    traced = torch.jit.freeze(traced)
+    torch.jit.save(traced, path, _extra_files={CONFIG_FILE: json.dumps(config)})
+
+
+def export_program(model, example, path, config, max_batch=1024):
+    """
+    Export the model with torch.export, the batch dimension is dynamic in [1, max_batch].
+    The example batch must have more than one image, size 1 would be specialized.
+    """
+    batch = torch.export.Dim("batch", min=1, max=max_batch)
+    with torch.no_grad():
+        program = torch.export.export(model, (example,), dynamic_shapes=({0: batch},))
+    torch.export.save(program, path, extra_files={CONFIG_FILE: json.dumps(config)})
+
+
+def load_artifact(path, device):
+    """
+    Load an artifact written by export.py, no model code is needed.
+
+    Args:
+        path (str) - .ts (TorchScript) or .pt2 (torch.export) file
+        device (torch.device) - inference device
+    Returns:
+        model - callable module in eval mode
+        config (dict) - model_config, img_channel, num_classes, mean, std, fused
+    """
+    extra_files = {CONFIG_FILE: ""}
+    if path.endswith(".pt2"):
+        program = torch.export.load(path, extra_files=extra_files)
+        model = program.module().to(device)
+    else :
+        model = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+        model.eval()
+    return model, json.loads(extra_files[CONFIG_FILE])
+
+
+class DynamicBatch(nn.Module):
+    """
+    torch.compile wrapper for training with a dynamic batch dimension.
+
+    Dimension 0 of every input is marked dynamic before the compiled model is called,
+    so the smaller last batch of an epoch (and the train / val batch sizes) reuse one
+    graph instead of recompiling. train() / eval() reach the wrapped model; save the
+    state dict of the original model, the wrapper adds prefixes to the keys.
+
+    Args:
+        model (nn.Module) - model to compile
+        mode (str) - torch.compile mode
+    """
+
+    def __init__(self, model, mode="default"):
+        super(DynamicBatch, self).__init__()
+        self.compiled = torch.compile(model, mode=mode)
+
+    def forward(self, x):
+        # batch为1时无法标记为动态维度
+        if x.shape[0] > 1:
+            torch._dynamo.mark_dynamic(x, 0)
+        return self.compiled(x)
+
+
+def main(args):
+    device = torch.device(args.device if torch.cuda.is_available() else "cpu")
+    print(f"using {device} device.")
+
+    model_weight_path = os.path.join(args.weights_dir, f"fold{args.fold}_{args.checkpoint}.pth")
+    model = build_model(args.model_config, args.img_channel, args.num_classes, model_weight_path, device, args.fuse)
+    print(f"loaded {model_weight_path}")
+
+    mean, std = get_normalization(args.img_channel)
+    config = dict(model_config=args.model_config, img_channel=args.img_channel, num_classes=args.num_classes,
+                  mean=mean, std=std, fused=args.fuse)
+    example = torch.randn((max(args.batch_size, 2), args.img_channel, 224, 224), device=device)
+
+    output = args.output
+    if args.format == "torchscript" :
+        output = output or os.path.join(args.weights_dir, f"fold{args.fold}_{args.checkpoint}.ts")
+        export_torchscript(model, example, output, config)
+    elif args.format == "export" :
+        output = output or os.path.join(args.weights_dir, f"fold{args.fold}_{args.checkpoint}.pt2")
+        export_program(model, example, output, config, args.max_batch)
+    else :
+        raise ValueError(f"unknown export format '{args.format}', use torchscript or export")
+
+    # 检查导出结果与原模型一致
+    exported, _ = load_artifact(output, device)
+    with torch.no_grad():
+        diff = (exported(example) - model(example)).abs().max().item()
+    print(f"saved {output}, max |logit diff| {diff:.2e}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('SAC model export for image classification', parents=[get_args_parser()])
+    args = parser.parse_args()
+    if args.weights_dir:
+        args.weights_dir = os.path.join(args.weights_dir, args.task, args.model_config)
+    main(args)
@@ -0,0 +1,159 @@
+import os
+import argparse
+from multiprocessing import Pool
+
+import torch
+import numpy as np
+import torch.nn.functional as F
+from PIL import Image
+from pytorch_grad_cam.utils.image import show_cam_on_image
+
+from utils import tensor2img
+
+
+class GradCAMEngine:
+    """
+    Batched Grad-CAM with hooks registered once on target_layers.
+
+    One forward pass is shared by all class targets, followed by one backward pass per
+    target. Each target is either a class index used for the whole batch or a sequence
+    of per-sample class indices. CAMs follow pytorch_grad_cam.GradCAM: channel weights
+    are the spatially averaged gradients, the weighted activations are summed, passed
+    through ReLU, min-max scaled and resized to the input size.
+
+    Args:
+        model (nn.Module) - model in eval mode
+        target_layers (list) - layers whose activations / gradients are used
+    """
+
+    def __init__(self, model, target_layers):
+        self.model = model
+        self.target_layers = target_layers
+        self.activations = []
+        self.gradients = []
+        self.handles = [layer.register_forward_hook(self._save_activation) for layer in target_layers]
+
+    def _save_activation(self, module, input, output):
+        # 普通的no_grad前向推理不需要保存
+        if not torch.is_grad_enabled():
+            return
+        self.activations.append(output.detach().clone())
+        if output.requires_grad:
+            def _save_gradient(grad):
+                # 反向传播时层的顺序是倒过来的
+                self.gradients.insert(0, grad.detach())
+            output.register_hook(_save_gradient)
+
+    @staticmethod
+    def _scale(cam, size):
+        cam = cam - cam.flatten(1).min(dim=1)[0].view(-1, 1, 1)
+        cam = cam / (1e-7 + cam.flatten(1).max(dim=1)[0].view(-1, 1, 1))
+        return F.interpolate(cam.unsqueeze(1), size=size, mode="bilinear", align_corners=False).squeeze(1)
+
+    def __call__(self, images, targets):
+        batch_size = images.shape[0]
+        size = images.shape[-2:]
+        self.activations = []
+
+        with torch.enable_grad():
+            output = self.model(images.detach().requires_grad_(True))
+            cams = []
+            for i, target in enumerate(targets):
+                if isinstance(target, int):
+                    target = [target] * batch_size
+                target = torch.as_tensor(target, device=output.device).view(-1, 1)
+                score = output.gather(1, target).sum()
+
+                self.gradients = []
+                self.model.zero_grad(set_to_none=True)
+                score.backward(retain_graph=i < len(targets) - 1)
+
+                layer_cams = []
+                for activation, gradient in zip(self.activations, self.gradients):
+                    weights = gradient.mean(dim=(2, 3), keepdim=True)
+                    cam = F.relu((weights * activation).sum(dim=1))
+                    layer_cams.append(self._scale(cam, size))
+                cam = torch.stack(layer_cams, dim=1).clamp(min=0).mean(dim=1)
+                cams.append(self._scale(cam, size).cpu().numpy())
+
+        self.model.zero_grad(set_to_none=True)
+        self.activations = []
+        self.gradients = []
+        return cams
+
+    def release(self):
+        for handle in self.handles:
+            handle.remove()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.release()
+
+
+def get_target_layers(model, model_config):
+    # Grad-CAM使用的特征层
+    if model_config.startswith("Res") :
+        return [model.layer4[-1]]
+    elif model_config.startswith("Dense") :
+        return [model.features[-1]]
+    elif model_config.startswith("Efficient") :
+        return [model.blocks[-1]]
+    elif model_config.startswith("ConvNeXt") :
+        return [model.stages[-1]]
+    raise ValueError("no Grad-CAM target layer for {}".format(model_config))
+
+
+def render_cam(image_tensor, cam):
+    rgb_img = tensor2img(image_tensor)
+    return Image.fromarray(show_cam_on_image(rgb_img, cam, use_rgb=True))
+
+
+def save_cam(image_tensor, cam, path):
+    render_cam(image_tensor, cam).save(path)
+
+
+def save_raw_cams(raw_dir, img_name, image_tensor, cams):
+    # 只保存原始CAM数组和输入图像，叠加图由render_raw_cams在之后单独生成
+    # cams: {子目录名: cam}，"cam" 表示直接保存在输出目录下
+    os.makedirs(raw_dir, exist_ok=True)
+    np.savez(os.path.join(raw_dir, img_name + ".npz"), image=tensor2img(image_tensor).astype(np.float32), **cams)
+
+
+def _render_raw(job):
+    raw_path, out_dir = job
+    img_name = os.path.split(raw_path)[-1][:-len(".npz")]
+    with np.load(raw_path) as raw:
+        rgb_img = raw["image"]
+        for key in raw.files:
+            if key == "image":
+                continue
+            save_dir = out_dir if key == "cam" else os.path.join(out_dir, key)
+            os.makedirs(save_dir, exist_ok=True)
+            visualization = show_cam_on_image(rgb_img, raw[key], use_rgb=True)
+            Image.fromarray(visualization).save(os.path.join(save_dir, img_name))
+
+
+def render_raw_cams(raw_dir, out_dir, num_workers=4):
+    jobs = [(item.path, out_dir) for item in os.scandir(raw_dir) if item.name.endswith(".npz")]
+    jobs.sort()
+    with Pool(num_workers) as pool:
+        for _ in pool.imap_unordered(_render_raw, jobs, chunksize=8):
+            pass
+    print("{} Grad-CAM overlays rendered to {}".format(len(jobs), out_dir))
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('SAC Grad-CAM overlay renderer', add_help=False)
+    parser.add_argument('--raw_dir', type=str, required=True, help='directory written with --grad_cam_raw')
+    parser.add_argument('--out_dir', type=str, required=True)
+    parser.add_argument('--num_workers', type=int, default=4)
+
+    return parser
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('SAC Grad-CAM overlay renderer', parents=[get_args_parser()])
+    args = parser.parse_args()
+    render_raw_cams(args.raw_dir, args.out_dir, args.num_workers)
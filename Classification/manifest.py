@@ -0,0 +1,69 @@
+import os
+import sqlite3
+
+SCHEMA_VERSION = 2
+
+
+class DatasetManifest:
+    """
+    Persistent directory index backed by SQLite.
+
+    For every listed directory the manifest keeps its mtime and its entries (name, is_dir,
+    size and mtime). A directory is only rescanned when its mtime changes, so repeated
+    read_dataset calls on large or network-mounted datasets do not walk the tree again.
+
+    Args:
+        db_path (str) - sqlite file, e.g. <data_path>/.manifest.sqlite
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        # timeout: 多个fold进程可能同时读写
+        self.conn = sqlite3.connect(db_path, timeout=60)
+        with self.conn:
+            # 旧版本的表结构（带内容hash）直接重建
+            if self.conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                self.conn.execute("DROP TABLE IF EXISTS dirs")
+                self.conn.execute("DROP TABLE IF EXISTS entries")
+                self.conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime INTEGER)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "dir TEXT, name TEXT, is_dir INTEGER, size INTEGER, mtime INTEGER, "
+                "PRIMARY KEY (dir, name))"
+            )
+
+    def _scan(self, path, dir_mtime):
+        rows = []
+        for item in os.scandir(path):
+            if item.is_dir():
+                rows.append((path, item.name, 1, 0, 0))
+                continue
+            st = item.stat()
+            rows.append((path, item.name, 0, st.st_size, st.st_mtime_ns))
+
+        with self.conn:
+            self.conn.execute("DELETE FROM entries WHERE dir = ?", (path,))
+            self.conn.executemany("INSERT INTO entries VALUES (?, ?, ?, ?, ?)", rows)
+            self.conn.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?)", (path, dir_mtime))
+
+    def listdir(self, path, dirs_only=False):
+        """Return [(name, is_dir, size)] of a directory, rescanning it if its mtime changed."""
+        path = os.path.abspath(path)
+        dir_mtime = os.stat(path).st_mtime_ns
+        row = self.conn.execute("SELECT mtime FROM dirs WHERE path = ?", (path,)).fetchone()
+        if row is None or row[0] != dir_mtime:
+            self._scan(path, dir_mtime)
+        query = "SELECT name, is_dir, size FROM entries WHERE dir = ?"
+        if dirs_only:
+            query += " AND is_dir = 1"
+        return [(name, bool(is_dir), size) for name, is_dir, size in self.conn.execute(query, (path,))]
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
@@ -7,6 +7,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from model.checkpoint import run_segments
+
 
 def drop_path(x, drop_prob: float = 0., training: bool = False):
     """Drop paths (Stochastic Depth) per sample (when applied in main path of residual blocks).
@@ -44,9 +46,11 @@ class LayerNorm(nn.Module):
     The ordering of the dimensions in the inputs. channels_last corresponds to inputs with
     shape (batch_size, height, width, channels) while channels_first corresponds to inputs
     with shape (batch_size, channels, height, width).
+    With fused=True channels_first inputs are normalized by F.layer_norm over a permuted
+    view, which is copy free for tensors in torch.channels_last memory format.
     """
 
-    def __init__(self, normalized_shape, eps=1e-6, data_format="channels_last"):
+    def __init__(self, normalized_shape, eps=1e-6, data_format="channels_last", fused=False):
         super().__init__()
         self.weight = nn.Parameter(torch.ones(normalized_shape), requires_grad=True)
         self.bias = nn.Parameter(torch.zeros(normalized_shape), requires_grad=True)
@@ -55,10 +59,15 @@ class LayerNorm(nn.Module):
         if self.data_format not in ["channels_last", "channels_first"]:
             raise ValueError(f"not support data format '{self.data_format}'")
         self.normalized_shape = (normalized_shape,)
+        self.fused = fused
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         if self.data_format == "channels_last":
             return F.layer_norm(x, self.normalized_shape, self.weight, self.bias, self.eps)
+        elif self.fused:
+            # [batch_size, channels, height, width] -> [batch_size, height, width, channels] -> back
+            x = F.layer_norm(x.permute(0, 2, 3, 1), self.normalized_shape, self.weight, self.bias, self.eps)
+            return x.permute(0, 3, 1, 2)
         elif self.data_format == "channels_first":
             # [batch_size, channels, height, width]
             mean = x.mean(1, keepdim=True)
@@ -73,6 +82,8 @@ class Block(nn.Module):
     (1) DwConv -> LayerNorm (channels_first) -> 1x1 Conv -> GELU -> 1x1 Conv; all in (N, C, H, W)
     (2) DwConv -> Permute to (N, H, W, C); LayerNorm (channels_last) -> Linear -> GELU -> Linear; Permute back
     We use (2) as we find it slightly faster in PyTorch
+    In ConvNeXt(channels_last=True) the input is already in channels_last memory format and
+    both permutes are views.
 
     Args:
         dim (int): Number of input channels.
@@ -118,19 +129,24 @@ class ConvNeXt(nn.Module):
         drop_path_rate (float): Stochastic depth rate. Default: 0.
         layer_scale_init_value (float): Init value for Layer Scale. Default: 1e-6.
         head_init_scale (float): Init scaling value for classifier weights and biases. Default: 1.
+        channels_last (bool): Keep activations and conv weights in torch.channels_last memory format
+            end to end. The permutes inside Block become views and the channels_first LayerNorms use
+            F.layer_norm, so no layout copies are made. Same parameters and state dict as the default
+            layout, outputs match up to float rounding. Default: False
     """
     def __init__(self, in_channels: int = 3, num_classes: int = 1000, depths: list = None,
                  dims: list = None, drop_path_rate: float = 0., layer_scale_init_value: float = 1e-6,
-                 head_init_scale: float = 1.):
+                 head_init_scale: float = 1., channels_last: bool = False):
         super().__init__()
+        self.channels_last = channels_last
         self.downsample_layers = nn.ModuleList()  # stem and 3 intermediate downsampling conv layers
         stem = nn.Sequential(nn.Conv2d(in_channels, dims[0], kernel_size=4, stride=4),
-                             LayerNorm(dims[0], eps=1e-6, data_format="channels_first"))
+                             LayerNorm(dims[0], eps=1e-6, data_format="channels_first", fused=channels_last))
         self.downsample_layers.append(stem)
 
         # 对应stage2-stage4前的3个downsample
         for i in range(3):
-            downsample_layer = nn.Sequential(LayerNorm(dims[i], eps=1e-6, data_format="channels_first"),
+            downsample_layer = nn.Sequential(LayerNorm(dims[i], eps=1e-6, data_format="channels_first", fused=channels_last),
                                              nn.Conv2d(dims[i], dims[i+1], kernel_size=2, stride=2))
             self.downsample_layers.append(downsample_layer)
 
@@ -145,12 +161,16 @@ class ConvNeXt(nn.Module):
             )
             self.stages.append(stage)
             cur += depths[i]
+        # >0 时每个stage分段做activation checkpointing，见set_checkpoint_segments
+        self.checkpoint_segments = 0
 
         self.norm = nn.LayerNorm(dims[-1], eps=1e-6)  # final norm layer
         self.head = nn.Linear(dims[-1], num_classes)
         self.apply(self._init_weights)
         self.head.weight.data.mul_(head_init_scale)
         self.head.bias.data.mul_(head_init_scale)
+        if channels_last:
+            self.to(memory_format=torch.channels_last)
 
     def _init_weights(self, m):
         if isinstance(m, (nn.Conv2d, nn.Linear)):
@@ -158,9 +178,11 @@ class ConvNeXt(nn.Module):
             nn.init.constant_(m.bias, 0)
 
     def forward_features(self, x: torch.Tensor) -> torch.Tensor:
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
         for i in range(4):
             x = self.downsample_layers[i](x)
-            x = self.stages[i](x)
+            x = run_segments(self.stages[i], x, self.checkpoint_segments)
 
         return self.norm(x.mean([-2, -1]))  # global average pooling, (N, C, H, W) -> (N, C)
 
@@ -170,48 +192,53 @@ class ConvNeXt(nn.Module):
         return x
 
 
-def convnext_tiny(in_channels: int, num_classes: int):
+def convnext_tiny(in_channels: int, num_classes: int, **kwargs):
     # https://dl.fbaipublicfiles.com/convnext/convnext_tiny_1k_224_ema.pth
     model = ConvNeXt(in_channels=in_channels, 
                      depths=[3, 3, 9, 3],
                      dims=[96, 192, 384, 768],
-                     num_classes=num_classes)
+                     num_classes=num_classes,
+                     **kwargs)
     return model
 
 
-def convnext_small(in_channels: int, num_classes: int):
+def convnext_small(in_channels: int, num_classes: int, **kwargs):
     # https://dl.fbaipublicfiles.com/convnext/convnext_small_1k_224_ema.pth
     model = ConvNeXt(in_channels=in_channels, 
                      depths=[3, 3, 27, 3],
                      dims=[96, 192, 384, 768],
-                     num_classes=num_classes)
+                     num_classes=num_classes,
+                     **kwargs)
     return model
 
 
-def convnext_base(in_channels: int, num_classes: int):
+def convnext_base(in_channels: int, num_classes: int, **kwargs):
     # https://dl.fbaipublicfiles.com/convnext/convnext_base_1k_224_ema.pth
     # https://dl.fbaipublicfiles.com/convnext/convnext_base_22k_224.pth
     model = ConvNeXt(in_channels=in_channels, 
                      depths=[3, 3, 27, 3],
                      dims=[128, 256, 512, 1024],
-                     num_classes=num_classes)
+                     num_classes=num_classes,
+                     **kwargs)
     return model
 
 
-def convnext_large(in_channels: int, num_classes: int):
+def convnext_large(in_channels: int, num_classes: int, **kwargs):
     # https://dl.fbaipublicfiles.com/convnext/convnext_large_1k_224_ema.pth
     # https://dl.fbaipublicfiles.com/convnext/convnext_large_22k_224.pth
     model = ConvNeXt(in_channels=in_channels, 
                      depths=[3, 3, 27, 3],
                      dims=[192, 384, 768, 1536],
-                     num_classes=num_classes)
+                     num_classes=num_classes,
+                     **kwargs)
     return model
 
 
-def convnext_xlarge(in_channels: int, num_classes: int):
+def convnext_xlarge(in_channels: int, num_classes: int, **kwargs):
     # https://dl.fbaipublicfiles.com/convnext/convnext_xlarge_22k_224.pth
     model = ConvNeXt(in_channels=in_channels, 
                      depths=[3, 3, 27, 3],
                      dims=[256, 512, 1024, 2048],
-                     num_classes=num_classes)
+                     num_classes=num_classes,
+                     **kwargs)
     return model
@@ -5,9 +5,10 @@ from collections import OrderedDict
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import torch.utils.checkpoint as cp
 from torch import Tensor
 
+from model.checkpoint import checkpoint
+
 
 class _DenseLayer(nn.Module):
     def __init__(self,
@@ -37,7 +38,8 @@ class _DenseLayer(nn.Module):
         self.memory_efficient = memory_efficient
 
     def bn_function(self, inputs: List[Tensor]) -> Tensor:
-        concat_features = torch.cat(inputs, 1)
+        # shared_buffer模式下输入已经是共享缓冲区中的一个视图，不需要再拼接
+        concat_features = inputs[0] if len(inputs) == 1 else torch.cat(inputs, 1)
         bottleneck_output = self.conv1(self.relu1(self.norm1(concat_features)))
         return bottleneck_output
 
@@ -54,7 +56,8 @@ class _DenseLayer(nn.Module):
         def closure(*inp):
             return self.bn_function(inp)
 
-        return cp.checkpoint(closure, *inputs)
+        # 非reentrant的checkpoint，重计算时不再更新norm1的running统计量
+        return checkpoint(closure, [self.norm1], *inputs)
 
     def forward(self, inputs: Tensor) -> Tensor:
         if isinstance(inputs, Tensor):
@@ -79,6 +82,52 @@ class _DenseLayer(nn.Module):
         return new_features
 
 
+class _SharedStorage:
+    """
+    Block-wide feature buffer of a _DenseBlock in shared_buffer mode.
+
+    The buffer holds all channels of the block output. It is allocated once per forward
+    pass and every feature map is copied into its channel slice exactly once.
+    """
+
+    def __init__(self, init_features: Tensor, num_channels: int):
+        n, _, h, w = init_features.shape
+        memory_format = torch.contiguous_format
+        if not init_features.is_contiguous() and init_features.is_contiguous(memory_format=torch.channels_last):
+            memory_format = torch.channels_last
+        self.storage = torch.empty((n, num_channels, h, w), dtype=init_features.dtype,
+                                   device=init_features.device, memory_format=memory_format)
+        self.num_features = 0
+        self.num_channels = 0
+
+
+class _SharedConcat(torch.autograd.Function):
+    """
+    torch.cat(features, 1) that returns a view of the shared buffer.
+
+    Only features not yet in the buffer are copied. The copies go through `.data`, so
+    they do not bump the version counter of views handed out earlier (those views only
+    cover channels that are never written again), and nothing is saved for backward:
+    the gradient is simply split per input feature, as for torch.cat.
+    """
+
+    @staticmethod
+    def forward(ctx, holder, *features):
+        ctx.sizes = [f.shape[1] for f in features]
+        ctx.dtypes = [f.dtype for f in features]
+        data = holder.storage.data
+        for f in features[holder.num_features:]:
+            data[:, holder.num_channels:holder.num_channels + f.shape[1]].copy_(f)
+            holder.num_channels += f.shape[1]
+        holder.num_features = len(features)
+        return holder.storage[:, :sum(ctx.sizes)]
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grads = grad_output.split(ctx.sizes, dim=1)
+        return (None,) + tuple(g.to(dtype) for g, dtype in zip(grads, ctx.dtypes))
+
+
 class _DenseBlock(nn.ModuleDict):
     _version = 2
 
@@ -88,8 +137,11 @@ class _DenseBlock(nn.ModuleDict):
                  bn_size: int,
                  growth_rate: int,
                  drop_rate: float,
-                 memory_efficient: bool = False):
+                 memory_efficient: bool = False,
+                 shared_buffer: bool = False):
         super(_DenseBlock, self).__init__()
+        self.num_channels = input_c + num_layers * growth_rate
+        self.shared_buffer = shared_buffer
         for i in range(num_layers):
             layer = _DenseLayer(input_c + i * growth_rate,
                                 growth_rate=growth_rate,
@@ -100,6 +152,14 @@ class _DenseBlock(nn.ModuleDict):
 
     def forward(self, init_features: Tensor) -> Tensor:
         features = [init_features]
+        if self.shared_buffer:
+            # 每层只读取共享缓冲区前缀的视图，输出写入缓冲区中自己的通道段
+            holder = _SharedStorage(init_features, self.num_channels)
+            for name, layer in self.items():
+                new_features = layer(_SharedConcat.apply(holder, *features))
+                features.append(new_features)
+            return _SharedConcat.apply(holder, *features)
+
         for name, layer in self.items():
             new_features = layer(features)
             features.append(new_features)
@@ -134,6 +194,8 @@ class DenseNet(nn.Module):
         drop_rate (float) - dropout rate after each dense layer
         num_classes (int) - number of classification classes
         memory_efficient (bool) - If True, uses checkpointing. Much more memory efficient
+        shared_buffer (bool) - If True, each dense block writes its feature maps into one
+          pre-allocated buffer instead of concatenating them for every layer
     """
 
     def __init__(self,
@@ -144,7 +206,8 @@ class DenseNet(nn.Module):
                  bn_size: int = 4,
                  drop_rate: float = 0,
                  num_classes: int = 1000,
-                 memory_efficient: bool = False):
+                 memory_efficient: bool = False,
+                 shared_buffer: bool = False):
         super(DenseNet, self).__init__()
 
         # first conv+bn+relu+pool
@@ -163,7 +226,8 @@ class DenseNet(nn.Module):
                                 bn_size=bn_size,
                                 growth_rate=growth_rate,
                                 drop_rate=drop_rate,
-                                memory_efficient=memory_efficient)
+                                memory_efficient=memory_efficient,
+                                shared_buffer=shared_buffer)
             self.features.add_module("denseblock%d" % (i + 1), block)
             num_features = num_features + num_layers * growth_rate
 
@@ -6,6 +6,8 @@ import torch.nn as nn
 import torch
 from torch import Tensor
 
+from model.checkpoint import run_segments
+
 # pretrain model
 # https://pan.baidu.com/s/1uZX36rvrfEss-JGj4yfzbQ
 # 5gu1
@@ -277,6 +279,8 @@ class EfficientNetV2(nn.Module):
                                  norm_layer=norm_layer))
                 block_id += 1
         self.blocks = nn.Sequential(*blocks)
+        # >0 时blocks分段做activation checkpointing，见set_checkpoint_segments
+        self.checkpoint_segments = 0
 
         head_input_c = model_cnf[-1][-3]
         head = OrderedDict()
@@ -310,7 +314,7 @@ class EfficientNetV2(nn.Module):
 
     def forward(self, x: Tensor) -> Tensor:
         x = self.stem(x)
-        x = self.blocks(x)
+        x = run_segments(self.blocks, x, self.checkpoint_segments)
         x = self.head(x)
 
         return x
@@ -1,6 +1,8 @@
 import torch.nn as nn
 import torch
 
+from model.checkpoint import run_segments
+
 class BasicBlock(nn.Module):
     expansion = 1
 
@@ -98,6 +100,8 @@ class ResNet(nn.Module):
         self.include_top = include_top
         self.input_channel = 64
 
+        # >0 时layer1-4分段做activation checkpointing，见set_checkpoint_segments
+        self.checkpoint_segments = 0
         self.groups = groups
         self.width_per_group = width_per_group
 
@@ -148,10 +152,10 @@ class ResNet(nn.Module):
         x = self.relu(x)
         x = self.maxpool(x)
 
-        x = self.layer1(x)
-        x = self.layer2(x)
-        x = self.layer3(x)
-        x = self.layer4(x)
+        x = run_segments(self.layer1, x, self.checkpoint_segments)
+        x = run_segments(self.layer2, x, self.checkpoint_segments)
+        x = run_segments(self.layer3, x, self.checkpoint_segments)
+        x = run_segments(self.layer4, x, self.checkpoint_segments)
 
         if self.include_top:
             x = self.avgpool(x)
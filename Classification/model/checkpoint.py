@@ -0,0 +1,96 @@
+import math
+from functools import partial
+
+import torch
+import torch.nn as nn
+import torch.utils.checkpoint as cp
+from torch.nn.modules.batchnorm import _BatchNorm
+
+
+class _Recompute:
+    """
+    A function recomputed in backward by torch.utils.checkpoint.
+
+    The first call is the normal forward pass. On the recomputation the momentum of the
+    BatchNorms inside `modules` is set to 0, so running statistics are not updated a
+    second time.
+    """
+
+    def __init__(self, fn, modules):
+        self.fn = fn
+        self.modules = modules
+        self.calls = 0
+
+    def __call__(self, *inputs):
+        self.calls += 1
+        if self.calls == 1:
+            return self.fn(*inputs)
+        # 反向传播中的重计算：不再更新BN的running_mean / running_var
+        bns = [m for module in self.modules for m in module.modules() if isinstance(m, _BatchNorm)]
+        momenta = [bn.momentum for bn in bns]
+        for bn in bns:
+            bn.momentum = 0.
+        try:
+            return self.fn(*inputs)
+        finally:
+            for bn, momentum in zip(bns, momenta):
+                bn.momentum = momentum
+
+
+def checkpoint(fn, modules, *inputs):
+    """
+    Non-reentrant torch.utils.checkpoint.checkpoint that updates the BatchNorm running
+    statistics of `modules` only once, in the forward pass.
+    """
+    return cp.checkpoint(_Recompute(fn, modules), *inputs, use_reentrant=False)
+
+
+def _run_layers(layers, x):
+    for layer in layers:
+        x = layer(x)
+    return x
+
+
+def run_segments(module: nn.Sequential, x: torch.Tensor, segments: int) -> torch.Tensor:
+    """
+    Run a Sequential with activation checkpointing over `segments` segments.
+
+    Only the segment inputs are kept during the forward pass, everything inside a
+    segment is recomputed in backward. Like torch.utils.checkpoint.checkpoint_sequential
+    the last segment is not checkpointed. The non-reentrant implementation is used, so
+    the parameters get gradients even when x does not require grad (e.g. raw images).
+    Falls back to module(x) when segments is 0, in eval mode or under no_grad.
+    """
+    if segments <= 0 or not module.training or not torch.is_grad_enabled():
+        return module(x)
+    layers = list(module)
+    size = math.ceil(len(layers) / min(segments, len(layers)))
+    for start in range(0, len(layers), size):
+        chunk = layers[start:start + size]
+        if start + size >= len(layers):
+            for layer in chunk:
+                x = layer(x)
+        else:
+            x = checkpoint(partial(_run_layers, chunk), chunk, x)
+    return x
+
+
+def set_checkpoint_segments(model: nn.Module, segments: int) -> nn.Module:
+    """
+    Turn on segment-level activation checkpointing for a model_zoo model.
+
+    ResNet (layer1-4), EfficientNetV2 (blocks) and ConvNeXt (every stage) are split
+    into `segments` checkpointed segments each. DenseNet uses its own memory_efficient
+    mode, which checkpoints the bottleneck of every dense layer, whatever the number of
+    segments. 0 turns checkpointing off (DenseNet's memory_efficient is left as it is).
+
+    Args:
+        model (nn.Module) - model from model_zoo
+        segments (int) - number of segments per checkpointed Sequential
+    """
+    for m in model.modules():
+        if hasattr(m, "checkpoint_segments"):
+            m.checkpoint_segments = segments
+        if segments > 0 and hasattr(m, "memory_efficient"):
+            m.memory_efficient = True
+    return model
@@ -0,0 +1,72 @@
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+
+class ScaleShift(nn.Module):
+    """
+    Eval-mode BatchNorm2d with the per-channel scale and shift precomputed.
+
+    Used for the pre-activation BN of DenseNet (BN -> ReLU -> conv), which cannot be
+    folded into a convolution.
+    """
+
+    def __init__(self, bn: nn.BatchNorm2d):
+        super(ScaleShift, self).__init__()
+        scale = bn.running_var.add(bn.eps).rsqrt()
+        shift = -bn.running_mean * scale
+        if bn.affine:
+            scale = scale * bn.weight
+            shift = shift * bn.weight + bn.bias
+        self.register_buffer("scale", scale.detach().view(1, -1, 1, 1))
+        self.register_buffer("shift", shift.detach().view(1, -1, 1, 1))
+
+    def forward(self, x):
+        return torch.addcmul(self.shift, x, self.scale)
+
+
+# (conv, bn) 属性对：卷积的输出只经过紧随其后的BN
+# ResNet BasicBlock/Bottleneck/stem、EfficientNet ConvBNAct、DenseNet _DenseLayer的conv1 -> norm2
+_CONV_BN_PAIRS = [("conv1", "bn1"), ("conv2", "bn2"), ("conv3", "bn3"), ("conv", "bn"), ("conv1", "norm2")]
+
+
+def _fuse_pair(module, conv_name, bn_name):
+    conv = getattr(module, conv_name, None)
+    bn = getattr(module, bn_name, None)
+    if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+        setattr(module, conv_name, fuse_conv_bn_eval(conv, bn))
+        setattr(module, bn_name, nn.Identity())
+
+
+@torch.no_grad()
+def fuse_for_inference(model: nn.Module) -> nn.Module:
+    """
+    Fold BatchNorm into the preceding convolution for inference.
+
+    Every BatchNorm2d that directly follows a Conv2d (ResNet blocks, downsample and stem,
+    EfficientNetV2 ConvBNAct, DenseNet stem and the bottleneck conv1 -> norm2) is folded
+    into the convolution weights and bias and replaced by nn.Identity. The remaining
+    pre-activation BNs of DenseNet (norm1, transition norm, norm5) become ScaleShift.
+    ConvNeXt has no BatchNorm and is returned unchanged. The model is modified in place
+    and put in eval mode, so load the weights first.
+
+    Args:
+        model (nn.Module) - model from model_zoo with loaded weights
+    Returns:
+        the fused model
+    """
+    model.eval()
+    for module in list(model.modules()):
+        for conv_name, bn_name in _CONV_BN_PAIRS:
+            _fuse_pair(module, conv_name, bn_name)
+        # nn.Sequential中相邻的Conv2d -> BatchNorm2d（ResNet downsample、DenseNet conv0 -> norm0）
+        if isinstance(module, nn.Sequential):
+            names = list(module._modules.keys())
+            for conv_name, bn_name in zip(names[:-1], names[1:]):
+                _fuse_pair(module, conv_name, bn_name)
+
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, nn.BatchNorm2d):
+                setattr(module, name, ScaleShift(child))
+    return model
@@ -7,12 +7,15 @@ import numpy as np
 from PIL import Image
 from torchvision import transforms
 from sklearn import metrics
-from pytorch_grad_cam import GradCAM
-from pytorch_grad_cam.utils.model_targets import ClassifierOutputTarget
-from pytorch_grad_cam.utils.image import show_cam_on_image
 
+from dataset import MyDataSet
+from gradcam import GradCAMEngine, get_target_layers, save_cam, save_raw_cams
+from writer import AsyncWriter
 from model.model_zoo import model_dict
-from utils import read_dataset, plot_test_metrics, tensor2img, resize_and_pad
+from model.fuse import fuse_for_inference
+from export import load_artifact
+from cache import ImageCache
+from utils import read_dataset, plot_test_metrics
 
 def get_args_parser():
     parser = argparse.ArgumentParser('SAC model testing script for image classification', add_help=False)
@@ -21,7 +24,15 @@ def get_args_parser():
     parser.add_argument('--data_path', type=str, default="dataset/Task3_crop")
     parser.add_argument('--img_channel', type=int, default=1)
     parser.add_argument('--fold', type=int, default=0)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--writer_workers', type=int, default=4, help='threads encoding output images, 0 to write synchronously')
+    parser.add_argument('--use_manifest', type=bool, default=False, help='cache directory listings in <data_path>/.manifest.sqlite')
+    parser.add_argument('--cache_dir', type=str, default='', help='pre-decoded image cache directory, empty to disable')
     parser.add_argument('--grad_cam', type=bool, default=True)
+    parser.add_argument('--fuse', type=bool, default=False, help='fold BatchNorm into convolutions for inference')
+    parser.add_argument('--artifact', type=str, default='', help='TorchScript (.ts) / torch.export (.pt2) file from export.py, replaces the checkpoint')
+    parser.add_argument('--grad_cam_raw', type=bool, default=False, help='only save raw CAM arrays, render them later with gradcam.py')
     parser.add_argument('--weights_dir', type=str, default='weights')
     parser.add_argument('--results_dir', type=str, default='results')
     parser.add_argument('--model_config', type=str, default='DenseNet169')
@@ -35,7 +46,7 @@ def main(args):
     print(f"using {device} device.")
     
     # load dataset
-    test_images_path, test_images_label = read_dataset(args.data_path, "test")
+    test_images_path, test_images_label = read_dataset(args.data_path, "test", args.use_manifest)
     test_images_predict = []
     test_image_class = []
     
@@ -51,50 +62,81 @@ def main(args):
         mean, std = [0.485, 0.456, 0.406], [0.229, 0.224, 0.225]
     else :
         mean, std = [0.5], [0.5]
+
+    cache = None
+    if args.cache_dir != "" :
+        cache = ImageCache(args.cache_dir, test_images_path, 224, args.img_channel)
+
+    test_dataset = MyDataSet(
+        images_path=test_images_path,
+        images_class=test_images_label,
+        is_train = False,
+        mean = mean,
+        std = std,
+        cache = cache,
+        augment = False
+    )
+    test_loader = torch.utils.data.DataLoader(
+        test_dataset,
+        batch_size=args.batch_size,
+        shuffle=False,
+        pin_memory=True,
+        num_workers=args.num_workers,
+        collate_fn=test_dataset.collate_fn
+    )
     
-    # create model
-    model = model_dict[args.model_config](in_channels=args.img_channel, num_classes=args.num_classes).to(device)
+    if args.artifact != "" and args.grad_cam :
+        # 导出的模型没有可挂hook的子模块
+        print("Grad-CAM is not available for exported artifacts, skipped.")
+        args.grad_cam = False
+
     if args.grad_cam :
         os.makedirs(os.path.join(args.results_dir, "grad_cam"), exist_ok=True)
-        if args.model_config.startswith("Res") :
-            target_layers = [model.layer4[-1]]
-        elif args.model_config.startswith("Dense") :
-            target_layers = [model.features[-1]]
-
-    # load model weights
-    model_weight_path = os.path.join(args.weights_dir, f"fold{args.fold}_last.pth")
-    model.load_state_dict(torch.load(model_weight_path, map_location=device))
-    model.eval()
-
-    # inference
-    for img_path, image_label in zip(test_images_path, test_images_label) :
-        # load image
-        img = Image.open(img_path)
-        if args.img_channel == 1 :
-            img = img.convert('L')
-        img = resize_and_pad(img, 224, mean, std, args.img_channel)
-        img = torch.unsqueeze(img, dim=0)
-        
-        # predict class
+
+    # create model and load weights, or load the exported artifact
+    if args.artifact != "" :
+        model, config = load_artifact(args.artifact, device)
+        assert config["img_channel"] == args.img_channel and config["num_classes"] == args.num_classes, \
+            "artifact {} was exported for {}".format(args.artifact, config)
+    else :
+        model = model_dict[args.model_config](in_channels=args.img_channel, num_classes=args.num_classes).to(device)
+        model_weight_path = os.path.join(args.weights_dir, f"fold{args.fold}_last.pth")
+        model.load_state_dict(torch.load(model_weight_path, map_location=device))
+        model.eval()
+        if args.fuse :
+            model = fuse_for_inference(model)
+    if args.grad_cam :
+        # 融合会替换BN层，目标层在融合之后再取
+        cam_engine = GradCAMEngine(model, get_target_layers(model, args.model_config))
+
+    writer = AsyncWriter(num_workers=args.writer_workers)
+
+    # inference, probabilities stay on the device until every batch is done
+    test_probs = []
+    img_idx = 0
+    for images, labels in test_loader :
+        images = images.to(device, non_blocking=True)
         with torch.no_grad():
-            output = torch.squeeze(model(img.to(device))).cpu()
-            predict = torch.softmax(output, dim=0)
-            predict_class = torch.argmax(predict).numpy()
-            test_images_predict.append(predict[1])
-            test_image_class.append(predict_class)
-            
-            if args.grad_cam :
-                torch.set_grad_enabled(True)
-                with GradCAM(model=model, target_layers=target_layers) as cam:
-                    targets = [ClassifierOutputTarget(image_label)]
-                    # aug_smooth=True, eigen_smooth=True 
-                    grayscale_cams = cam(input_tensor=img.to(device), targets=targets)
-                    for grayscale_cam, tensorg in zip(grayscale_cams,img.to(device)):
-                        rgb_img = tensor2img(tensorg)
-                        visualization = show_cam_on_image(rgb_img, grayscale_cam, use_rgb=True)
-                        imggrad = Image.fromarray(visualization)
-                        imggrad.save(os.path.join(args.results_dir, "grad_cam", os.path.split(img_path)[-1]))
-                torch.set_grad_enabled(False)
+            test_probs.append(torch.softmax(model(images), dim=1))
+
+        if args.grad_cam :
+            grayscale_cams = cam_engine(images, [labels.tolist()])[0]
+            for grayscale_cam, tensorg in zip(grayscale_cams, images.cpu()) :
+                img_name = os.path.split(test_images_path[img_idx])[-1]
+                img_idx += 1
+                if args.grad_cam_raw :
+                    writer.submit(save_raw_cams, os.path.join(args.results_dir, "grad_cam_raw"), img_name, tensorg, {"cam": grayscale_cam})
+                else :
+                    writer.submit(save_cam, tensorg, grayscale_cam, os.path.join(args.results_dir, "grad_cam", img_name))
+    test_probs = torch.cat(test_probs, dim=0).cpu()
+    if args.grad_cam :
+        cam_engine.release()
+    writer.close()
+
+    for img_path, image_label, predict in zip(test_images_path, test_images_label, test_probs) :
+        predict_class = torch.argmax(predict).numpy()
+        test_images_predict.append(predict[1])
+        test_image_class.append(predict_class)
         
         # result
         print("label: {}, img_path: {}, class: {}, prob: {:.3}".format(
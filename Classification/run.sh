@@ -23,3 +23,6 @@ done
 # # final
 # python train.py --fold 0 --task Task1_balanced --model_config DenseNet169 --data_path dataset/Task1_crop_balanced --epochs 80 --lr 2e-4
 # python train.py --fold 0 --task Task3_crop --model_config DenseNet169 --data_path dataset/Task3_crop --epochs 30 --lr 1e-4
+
+# # all five folds concurrently (one per GPU), with a shared decoded-image cache and cv_summary.txt
+# python train.py --folds all --task Task1_balanced_5fold --model_config DenseNet169 --data_path dataset/Task1_crop_balanced_5fold
@@ -0,0 +1,271 @@
+import io
+import os
+import json
+import time
+import queue
+import base64
+import argparse
+import threading
+import socketserver
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import torch
+from PIL import Image
+
+from gradcam import GradCAMEngine, get_target_layers, render_cam
+from model.model_zoo import model_dict
+from model.fuse import fuse_for_inference
+from export import load_artifact
+from utils import LetterBox
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('SAC inference service for image classification', add_help=False)
+    parser.add_argument('--num_classes', type=int, default=2)
+    parser.add_argument('--task', type=str, default="Task3_final")
+    parser.add_argument('--img_channel', type=int, default=1)
+    parser.add_argument('--fold', type=int, default=0)
+    parser.add_argument('--checkpoint', type=str, default='last', help='best or last')
+    parser.add_argument('--class_indices', type=str, default='', help='class_indices.json used to name the classes')
+    parser.add_argument('--max_batch', type=int, default=16, help='max requests per forward pass')
+    parser.add_argument('--max_latency', type=float, default=10.0, help='ms the first request of a batch waits for others')
+    parser.add_argument('--fuse', type=bool, default=False, help='fold BatchNorm into convolutions')
+    parser.add_argument('--artifact', type=str, default='', help='TorchScript (.ts) / torch.export (.pt2) file from export.py, replaces the checkpoint')
+    parser.add_argument('--grad_cam', type=bool, default=False, help='allow requests to ask for a Grad-CAM overlay')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--unix_socket', type=str, default='', help='serve on a unix socket instead of host:port')
+    parser.add_argument('--weights_dir', type=str, default='weights')
+    parser.add_argument('--model_config', type=str, default='DenseNet169')
+    parser.add_argument('--device', default='cuda:0', help='device id (i.e. 0 or 0,1 or cpu)')
+
+    return parser
+
+
+class InferenceService:
+    """
+    Long-lived classifier with dynamic request batching.
+
+    The checkpoint is loaded and warmed up once. submit() preprocesses an image exactly
+    like predict.py (LetterBox without augmentation) and returns a Future. A single
+    batching thread waits for the first pending request, then collects more until
+    max_batch requests are queued or max_latency ms have passed, and runs them through
+    one forward pass. Requests asking for a Grad-CAM are additionally run through a
+    shared GradCAMEngine, targeting the predicted class.
+
+    Args:
+        model (nn.Module) - classifier with loaded weights in eval mode, or an exported artifact
+        mean, std (list) - normalization used in training
+        device (torch.device) - inference device
+        max_batch (int) - max requests per forward pass
+        max_latency (float) - batching window in ms
+        target_layers (list) - Grad-CAM layers, None disables Grad-CAM
+        class_names (dict) - optional {index: name}
+    """
+
+    def __init__(self, model, mean, std, device, max_batch=16, max_latency=10.0, target_layers=None, class_names=None):
+        self.model = model
+        self.device = device
+        self.channels = len(mean)
+        self.letterbox = LetterBox(224, mean, std)
+        self.max_batch = max_batch
+        self.max_latency = max_latency / 1000
+        self.class_names = class_names or {}
+        self.cam_engine = GradCAMEngine(model, target_layers) if target_layers is not None else None
+        self.requests = queue.Queue()
+        self.running = True
+
+        self.warmup()
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def warmup(self):
+        # 首次前向推理会触发cudnn算法选择和显存分配，提前在最大和最小batch上各跑一次
+        for batch_size in sorted({1, self.max_batch}):
+            images = torch.zeros((batch_size, self.channels, 224, 224), device=self.device)
+            with torch.no_grad():
+                self.model(images)
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+    def preprocess(self, data):
+        img = Image.open(io.BytesIO(data))
+        img = img.convert('L') if self.channels == 1 else img.convert('RGB')
+        return self.letterbox(img)
+
+    def submit(self, data, grad_cam=False):
+        if grad_cam and self.cam_engine is None:
+            raise ValueError("Grad-CAM is not enabled, start the service with --grad_cam True")
+        future = Future()
+        self.requests.put((self.preprocess(data), grad_cam, future))
+        return future
+
+    def _collect(self):
+        batch = [self.requests.get()]
+        deadline = time.monotonic() + self.max_latency
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return [request for request in batch if request is not None]
+
+    def _loop(self):
+        while self.running:
+            batch = self._collect()
+            if len(batch) == 0:
+                continue
+            try:
+                results = self._forward(batch)
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, _, future), result in zip(batch, results):
+                future.set_result(result)
+
+    def _forward(self, batch):
+        images = torch.stack([image for image, _, _ in batch], dim=0).to(self.device, non_blocking=True)
+        with torch.no_grad():
+            probs = torch.softmax(self.model(images), dim=1).cpu()
+        results = []
+        for prob in probs:
+            predict_class = int(torch.argmax(prob))
+            results.append(dict(
+                probabilities=prob.tolist(),
+                class_index=predict_class,
+                class_name=self.class_names.get(str(predict_class), str(predict_class)),
+                prob=float(prob[predict_class])
+            ))
+
+        cam_idx = [i for i, (_, grad_cam, _) in enumerate(batch) if grad_cam]
+        if len(cam_idx) > 0:
+            cams = self.cam_engine(images[cam_idx], [[results[i]["class_index"] for i in cam_idx]])[0]
+            for i, cam in zip(cam_idx, cams):
+                buffer = io.BytesIO()
+                render_cam(images[i].cpu(), cam).save(buffer, format="PNG")
+                results[i]["grad_cam"] = base64.b64encode(buffer.getvalue()).decode("ascii")
+        return results
+
+    def close(self):
+        self.running = False
+        self.requests.put(None)
+        self.thread.join()
+        if self.cam_engine is not None:
+            self.cam_engine.release()
+
+
+def load_service(args):
+    device = torch.device(args.device if torch.cuda.is_available() else "cpu")
+    print(f"using {device} device.")
+
+    if args.img_channel == 3 :
+        mean, std = [0.485, 0.456, 0.406], [0.229, 0.224, 0.225]
+    else :
+        mean, std = [0.5], [0.5]
+
+    class_names = None
+    if args.class_indices != "" :
+        with open(args.class_indices, "r") as f:
+            class_names = json.load(f)
+
+    if args.artifact != "" :
+        if args.grad_cam :
+            raise ValueError("Grad-CAM is not available for exported artifacts")
+        model, config = load_artifact(args.artifact, device)
+        mean, std = config["mean"], config["std"]
+        print(f"loaded {args.artifact} ({config['model_config']})")
+        return InferenceService(model, mean, std, device, args.max_batch, args.max_latency, None, class_names)
+
+    model = model_dict[args.model_config](in_channels=args.img_channel, num_classes=args.num_classes).to(device)
+    model_weight_path = os.path.join(args.weights_dir, f"fold{args.fold}_{args.checkpoint}.pth")
+    model.load_state_dict(torch.load(model_weight_path, map_location=device))
+    model.eval()
+    print(f"loaded {model_weight_path}")
+    if args.fuse :
+        model = fuse_for_inference(model)
+
+    target_layers = get_target_layers(model, args.model_config) if args.grad_cam else None
+    return InferenceService(model, mean, std, device, args.max_batch, args.max_latency, target_layers, class_names)
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /predict with the raw image file as body, add ?grad_cam=1 for a base64 PNG
+    overlay. GET /health reports readiness. Responses are JSON.
+    """
+
+    service = None
+
+    def _reply(self, code, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if urlparse(self.path).path == "/health":
+            self._reply(200, {"status": "ok"})
+        else:
+            self._reply(404, {"error": "not found"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/predict":
+            self._reply(404, {"error": "not found"})
+            return
+        query = parse_qs(url.query)
+        grad_cam = query.get("grad_cam", ["0"])[0] in ("1", "true", "True")
+        try:
+            data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            future = self.service.submit(data, grad_cam)
+        except Exception as e:
+            self._reply(400, {"error": str(e)})
+            return
+        try:
+            self._reply(200, future.result())
+        except Exception as e:
+            self._reply(500, {"error": str(e)})
+
+    def address_string(self):
+        # unix socket的client_address不是 (host, port)
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return "unix"
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(args):
+    RequestHandler.service = load_service(args)
+    if args.unix_socket != "" :
+        if os.path.exists(args.unix_socket) :
+            os.remove(args.unix_socket)
+        server = ThreadingUnixHTTPServer(args.unix_socket, RequestHandler)
+        print(f"serving on unix socket {args.unix_socket}")
+    else :
+        server = ThreadingHTTPServer((args.host, args.port), RequestHandler)
+        print(f"serving on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        RequestHandler.service.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('SAC inference service for image classification', parents=[get_args_parser()])
+    args = parser.parse_args()
+    if args.weights_dir:
+        args.weights_dir = os.path.join(args.weights_dir, args.task, args.model_config)
+    serve(args)
@@ -1,14 +1,24 @@
 import os
+import copy
+import json
+import math
 import argparse
+import numpy as np
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 import torch
 import torch.optim as optim
 import torch.optim.lr_scheduler as lr_scheduler
 
-from dataset import MyDataSet
+from dataset import MyDataSet, ShardDataSet, ROIDataSet
+from cache import ImageCache
+from augment import BatchAugment
 from model.model_zoo import model_dict
+from model.checkpoint import set_checkpoint_segments
+from export import DynamicBatch
 
-from engine import train_one_epoch, evaluate
+from engine import train_one_epoch, evaluate, get_amp_dtype
 from utils import read_dataset, create_lr_scheduler, get_params_groups, plot_training_loss
 from model.DenseNet import load_state_dict
 
@@ -18,6 +28,7 @@ def get_args_parser():
     parser.add_argument('--epochs', type=int, default=80)
     parser.add_argument('--val_interval', type=int, default=5)
     parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--accum_steps', type=int, default=1, help='micro-batches accumulated per optimizer step')
     parser.add_argument('--num_workers', type=int, default=4)
     parser.add_argument('--lr', type=float, default=2e-4)
     parser.add_argument('--weight_decay', type=float, default=1e-3)
@@ -25,6 +36,21 @@ def get_args_parser():
     parser.add_argument('--data_path', type=str, default="dataset/Task1_crop_balanced_5fold")
     parser.add_argument('--img_channel', type=int, default=1)
     parser.add_argument('--fold', type=int, default=0)
+    parser.add_argument('--folds', type=str, default='', help='"all" or e.g. "1,3": train these folds concurrently')
+    parser.add_argument('--fold_workers', type=int, default=0, help='concurrent folds, 0 for one per device')
+    parser.add_argument('--gpu_augment', type=bool, default=False, help='run augmentation batched on the training device')
+    parser.add_argument('--amp', type=bool, default=False, help='mixed precision, fp16 on cuda / bf16 on cpu')
+    parser.add_argument('--channels_last', type=bool, default=False, help='use channels_last memory format')
+    parser.add_argument('--log_interval', type=int, default=20, help='refresh the progress bar every N steps')
+    parser.add_argument('--memory_efficient', type=bool, default=False, help='DenseNet: checkpoint the bottleneck of every dense layer')
+    parser.add_argument('--shared_buffer', type=bool, default=False, help='DenseNet: write dense block features into one pre-allocated buffer')
+    parser.add_argument('--compile', type=bool, default=False, help='torch.compile the model, batch dimension dynamic')
+    parser.add_argument('--checkpoint_segments', type=int, default=0, help='activation checkpointing segments per stage, 0 to disable')
+    parser.add_argument('--shard_dir', type=str, default='', help='read tar shards from data/pack_shards.py instead of image files')
+    parser.add_argument('--shuffle_buffer', type=int, default=1000)
+    parser.add_argument('--roi_dir', type=str, default='', help='crop ROIs on the fly from <split>_rois.json (save_crops=False)')
+    parser.add_argument('--use_manifest', type=bool, default=False, help='cache directory listings in <data_path>/.manifest.sqlite')
+    parser.add_argument('--cache_dir', type=str, default='', help='pre-decoded image cache directory, empty to disable')
     parser.add_argument('--weights_dir', type=str, default='weights')
     parser.add_argument('--results_dir', type=str, default='results')
     parser.add_argument('--model_config', type=str, default='DenseNet169')
@@ -35,35 +61,40 @@ def get_args_parser():
     return parser
 
 
-def main(args):
-    device = torch.device(args.device if torch.cuda.is_available() else "cpu")
-    print(f"using {device} device.")
+def read_folds(data_path, use_manifest=False):
+    return {f: read_dataset(data_path, f"fold{f}", use_manifest) for f in range(1, 6)}
+
 
+def build_datasets(args, mean, std, fold_data=None):
     # load dataset
     if args.fold != 0 :
+        if fold_data is None :
+            fold_data = read_folds(args.data_path, args.use_manifest)
         train_images_path, train_images_label = [], []
         for f in range(1, 6) :
-            fold_path, fold_label = read_dataset(args.data_path, f"fold{f}")
+            fold_path, fold_label = fold_data[f]
             if args.fold == f :
                 val_images_path, val_images_label = fold_path, fold_label
             else :
                 train_images_path += fold_path
                 train_images_label += fold_label
     else :
-        train_images_path, train_images_label = read_dataset(args.data_path, "trainval")
-        val_images_path, val_images_label = read_dataset(args.data_path, "test")
+        train_images_path, train_images_label = read_dataset(args.data_path, "trainval", args.use_manifest)
+        val_images_path, val_images_label = read_dataset(args.data_path, "test", args.use_manifest)
     
-    if args.img_channel == 3 :
-        mean, std = [0.485, 0.456, 0.406], [0.229, 0.224, 0.225]
-    else :
-        mean, std = [0.5], [0.5]
+    # decoded image cache, shared by all folds and predict.py
+    cache = None
+    if args.cache_dir != "" :
+        cache = ImageCache(args.cache_dir, train_images_path + val_images_path, 224, args.img_channel)
 
     train_dataset = MyDataSet(
         images_path=train_images_path,
         images_class=train_images_label,
         is_train = True, 
         mean = mean, 
-        std = std
+        std = std,
+        cache = cache,
+        gpu_augment = args.gpu_augment
     )
 
     val_dataset = MyDataSet(
@@ -71,14 +102,68 @@ def main(args):
         images_class=val_images_label,
         is_train = False, 
         mean = mean, 
-        std = std
+        std = std,
+        cache = cache,
+        gpu_augment = args.gpu_augment
     )
 
+    return train_dataset, val_dataset
+
+
+def build_roi_datasets(args, mean, std):
+    if args.fold != 0 :
+        train_splits = [f"fold{f}" for f in range(1, 6) if f != args.fold]
+        val_splits = [f"fold{args.fold}"]
+    elif os.path.exists(os.path.join(args.roi_dir, "trainval_rois.json")) :
+        train_splits, val_splits = ["trainval"], ["test"]
+    else :
+        train_splits, val_splits = ["train", "val"], ["test"]
+
+    train_dataset = ROIDataSet(args.roi_dir, train_splits, is_train=True, mean=mean, std=std, gpu_augment=args.gpu_augment)
+    val_dataset = ROIDataSet(args.roi_dir, val_splits, is_train=False, mean=mean, std=std, gpu_augment=args.gpu_augment)
+
+    # full-size images are decoded once, crops are taken from the cache
+    if args.cache_dir != "" :
+        cache = ImageCache(args.cache_dir, sorted(set(train_dataset.images_path + val_dataset.images_path)), 0, args.img_channel)
+        train_dataset.cache = cache
+        val_dataset.cache = cache
+
+    return train_dataset, val_dataset
+
+
+def main(args, fold_data=None):
+    device = torch.device(args.device if torch.cuda.is_available() else "cpu")
+    print(f"using {device} device.")
+
+    if args.img_channel == 3 :
+        mean, std = [0.485, 0.456, 0.406], [0.229, 0.224, 0.225]
+    else :
+        mean, std = [0.5], [0.5]
+
+    if args.shard_dir != "" :
+        # streaming datasets over packed tar shards
+        if args.fold != 0 :
+            train_splits = [f"fold{f}" for f in range(1, 6) if f != args.fold]
+            val_splits = [f"fold{args.fold}"]
+        else :
+            train_splits, val_splits = ["trainval"], ["test"]
+        train_dataset = ShardDataSet(args.shard_dir, train_splits, is_train=True, mean=mean, std=std,
+                                     gpu_augment=args.gpu_augment, shuffle_buffer=args.shuffle_buffer)
+        val_dataset = ShardDataSet(args.shard_dir, val_splits, is_train=False, mean=mean, std=std,
+                                   gpu_augment=args.gpu_augment)
+    elif args.roi_dir != "" :
+        train_dataset, val_dataset = build_roi_datasets(args, mean, std)
+    else :
+        train_dataset, val_dataset = build_datasets(args, mean, std, fold_data)
+
+    batch_augment = BatchAugment(mean, std).to(device) if args.gpu_augment else None
+
     # build dataloader
     train_loader = torch.utils.data.DataLoader(
         train_dataset,
         batch_size=args.batch_size,
-        shuffle=True,
+        # IterableDataset shuffles through its own buffer
+        shuffle=not isinstance(train_dataset, ShardDataSet),
         pin_memory=True,
         num_workers=args.num_workers,
         collate_fn=train_dataset.collate_fn
@@ -105,7 +190,8 @@ def main(args):
         model.fc = torch.nn.Linear(in_channel, args.num_classes)
     elif args.model_config.startswith("Dense") :
         # DenseNet
-        model = model_dict[args.model_config](in_channels=args.img_channel, num_classes=args.num_classes).to(device)
+        model = model_dict[args.model_config](in_channels=args.img_channel, num_classes=args.num_classes,
+                                              memory_efficient=args.memory_efficient, shared_buffer=args.shared_buffer).to(device)
         if args.pretrained != "" and args.img_channel == 3:
             if os.path.exists(args.pretrained):
                 load_state_dict(model, args.pretrained)
@@ -123,7 +209,8 @@ def main(args):
                 raise FileNotFoundError("not found weights file: {}".format(args.weights))
     elif args.model_config.startswith("Conv") :
         # ConvNeXt
-        model = model_dict[args.model_config](in_channels=args.img_channel, num_classes=args.num_classes).to(device)
+        model = model_dict[args.model_config](in_channels=args.img_channel, num_classes=args.num_classes,
+                                              channels_last=args.channels_last).to(device)
         if args.pretrained != "" and args.img_channel == 3:
             assert os.path.exists(args.pretrained), "pretrained file: '{}' not exist.".format(args.pretrained)
             pretrained_dict = torch.load(args.pretrained, map_location=device)["model"]
@@ -143,36 +230,62 @@ def main(args):
                 print("training {}".format(name))
     
     model.to(device)
+    if args.checkpoint_segments > 0:
+        set_checkpoint_segments(model, args.checkpoint_segments)
+    if args.channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    # 编译后的模型只用于前向/反向，保存权重仍使用原模型的state_dict
+    net = DynamicBatch(model) if args.compile else model
+
+    amp_dtype = get_amp_dtype(device) if args.amp else None
+    scaler = torch.amp.GradScaler("cuda") if amp_dtype == torch.float16 else None
 
     parameters = get_params_groups(model, weight_decay=args.weight_decay)
     # optimizer = optim.SGD(parameters, lr=args.lr, momentum=0.9, weight_decay=args.weight_decay, nesterov=True)
     optimizer = optim.Adam(parameters, lr=args.lr, weight_decay=args.weight_decay)
-    lr_scheduler = create_lr_scheduler(optimizer, len(train_loader), args.epochs, warmup=True, warmup_epochs=3)
+    # the schedule counts optimizer steps, not micro-batches
+    num_batches = len(train_loader)
+    if isinstance(train_dataset, ShardDataSet) and args.num_workers > 1 :
+        # 每个worker各自产生最后一个不满的batch，len(train_loader)会少算最多num_workers-1个batch
+        num_batches += min(args.num_workers, len(train_dataset.shards)) - 1
+    num_step = math.ceil(num_batches / args.accum_steps)
+    lr_scheduler = create_lr_scheduler(optimizer, num_step, args.epochs, warmup=True, warmup_epochs=3)
 
     # train
     train_losses = []
     val_losses = []
     max_accuracy = 0.0
+    best_epoch = 0
     
     log_file = open(f"{args.results_dir}/fold{args.fold}_training.txt", 'w')
 
     for epoch in range(1, args.epochs + 1):
         # train
         train_loss, train_acc = train_one_epoch(
-            model=model,
+            model=net,
             optimizer=optimizer,
             data_loader=train_loader,
             device=device,
             epoch=epoch,
-            lr_scheduler=lr_scheduler
+            lr_scheduler=lr_scheduler,
+            batch_augment=batch_augment,
+            amp_dtype=amp_dtype,
+            scaler=scaler,
+            channels_last=args.channels_last,
+            log_interval=args.log_interval,
+            accum_steps=args.accum_steps
         )
 
         # validate
         val_loss, val_acc = evaluate(
-            model=model,
+            model=net,
             data_loader=val_loader,
             device=device,
-            epoch=epoch
+            epoch=epoch,
+            batch_augment=batch_augment,
+            amp_dtype=amp_dtype,
+            channels_last=args.channels_last,
+            log_interval=args.log_interval
         )
         
         # logging
@@ -185,12 +298,79 @@ def main(args):
         if max_accuracy <= val_acc and epoch > 5:
             torch.save(model.state_dict(), os.path.join(args.weights_dir, f"fold{args.fold}_best.pth"))
             max_accuracy = val_acc
+            best_epoch = epoch
             log_file.write(", best for now !!")
         log_file.write("\n")
 
     # finish
     torch.save(model.state_dict(), os.path.join(args.weights_dir, f"fold{args.fold}_last.pth"))
     plot_training_loss(train_losses, val_losses, args)
+    log_file.close()
+
+    return {
+        "fold": args.fold,
+        "best_acc": max_accuracy,
+        "best_epoch": best_epoch,
+        "last_acc": val_acc,
+        "last_train_loss": train_loss,
+        "last_val_loss": val_loss,
+    }
+
+
+def _train_fold(args, fold_data, num_threads):
+    torch.set_num_threads(num_threads)
+    return main(args, fold_data)
+
+
+def run_folds(args):
+    folds = list(range(1, 6)) if args.folds == "all" else [int(f) for f in args.folds.split(",")]
+
+    # read every fold directory once and build one decoded-image cache for all workers
+    fold_data = None
+    if args.shard_dir == "" and args.roi_dir == "" :
+        fold_data = read_folds(args.data_path, args.use_manifest)
+        if args.cache_dir == "" :
+            args.cache_dir = os.path.join(args.data_path, ".cache")
+        all_paths = [p for f in range(1, 6) for p in fold_data[f][0]]
+        ImageCache(args.cache_dir, all_paths, 224, args.img_channel)
+    elif args.roi_dir != "" and args.cache_dir != "" :
+        all_paths = set()
+        for f in range(1, 6) :
+            with open(os.path.join(args.roi_dir, f"fold{f}_rois.json"), "r") as fp :
+                all_paths.update(roi["image"] for roi in json.load(fp))
+        ImageCache(args.cache_dir, sorted(all_paths), 0, args.img_channel)
+
+    if torch.cuda.is_available() :
+        devices = [f"cuda:{i}" for i in range(torch.cuda.device_count())]
+    else :
+        devices = ["cpu"]
+    num_workers = min(args.fold_workers if args.fold_workers > 0 else len(devices), len(folds))
+    num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+
+    results = []
+    # spawn: cuda cannot be re-initialised in forked processes
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = []
+        for i, f in enumerate(folds) :
+            fold_args = copy.copy(args)
+            fold_args.fold = f
+            fold_args.device = devices[i % len(devices)]
+            futures.append(pool.submit(_train_fold, fold_args, fold_data, num_threads))
+        for future in futures :
+            results.append(future.result())
+
+    # cross-validation summary
+    with open(os.path.join(args.results_dir, "cv_summary.txt"), "w") as f :
+        for r in results :
+            line = "fold{}: best_acc: {:.4f} (epoch {}), last_acc: {:.4f}, train_loss: {:.4f}, val_loss: {:.4f}".format(
+                r["fold"], r["best_acc"], r["best_epoch"], r["last_acc"], r["last_train_loss"], r["last_val_loss"])
+            print(line)
+            f.write(line + "\n")
+        for key in ["best_acc", "last_acc"] :
+            values = np.array([r[key] for r in results])
+            line = "{} mean: {:.4f}, std: {:.4f}".format(key, values.mean(), values.std())
+            print(line)
+            f.write(line + "\n")
 
 
 if __name__ == '__main__':
@@ -202,4 +382,7 @@ if __name__ == '__main__':
     if args.results_dir:
         args.results_dir = os.path.join(args.results_dir, args.task, args.model_config, "train")
         os.makedirs(args.results_dir, exist_ok=True)
-    main(args)
\ No newline at end of file
+    if args.folds != "" :
+        run_folds(args)
+    else :
+        main(args)
\ No newline at end of file
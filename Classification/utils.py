@@ -2,6 +2,7 @@ import os
 import json
 import random
 import math
+import sqlite3
 import torch
 import matplotlib.pyplot as plt
 import numpy as np
@@ -9,21 +10,50 @@ from PIL import Image
 from sklearn import metrics
 from torchvision import transforms
 
+from manifest import DatasetManifest
 
-def read_dataset(ori_root: str, split: str):
+
+def open_manifest(ori_root):
+    # 数据集目录只读（共享挂载）或无法打开sqlite时退回os.scandir
+    db_path = os.path.join(ori_root, ".manifest.sqlite")
+    if not os.access(ori_root, os.W_OK) or (os.path.exists(db_path) and not os.access(db_path, os.W_OK)):
+        print("{} is not writable, listing the dataset without manifest.".format(ori_root))
+        return None
+    try:
+        return DatasetManifest(db_path)
+    except sqlite3.Error as e:
+        print("cannot open {} ({}), listing the dataset without manifest.".format(db_path, e))
+        return None
+
+
+def read_dataset(ori_root: str, split: str, use_manifest: bool = False):
     # random.seed(0)  # 保证随机结果可复现
     root = os.path.join(ori_root, split)
     assert os.path.exists(root), "dataset root: {} does not exist.".format(root)
 
+    # use_manifest: 目录列表缓存在 <ori_root>/.manifest.sqlite 中，目录mtime不变时不再重新遍历
+    manifest = open_manifest(ori_root) if use_manifest else None
+
     # 遍历文件夹，一个文件夹对应一个类别
-    classes = [cla for cla in os.listdir(root) if os.path.isdir(os.path.join(root, cla))]
+    if manifest is not None:
+        classes = [name for name, _, _ in manifest.listdir(root, dirs_only=True)]
+    else:
+        classes = [cla for cla in os.listdir(root) if os.path.isdir(os.path.join(root, cla))]
     # 排序，保证各平台顺序一致
     classes.sort()
     # 生成类别名称以及对应的数字索引
     class_indices = dict((k, v) for v, k in enumerate(classes))
     json_str = json.dumps(dict((val, key) for key, val in class_indices.items()), indent=4)
-    with open(os.path.join(ori_root, 'class_indices.json'), 'w') as json_file:
-        json_file.write(json_str)
+    # 内容不变时不重写，避免多个进程同时读写
+    json_path = os.path.join(ori_root, 'class_indices.json')
+    old_json_str = None
+    if os.path.exists(json_path):
+        with open(json_path, 'r') as json_file:
+            old_json_str = json_file.read()
+    if old_json_str != json_str:
+        with open(json_path + '.tmp', 'w') as json_file:
+            json_file.write(json_str)
+        os.replace(json_path + '.tmp', json_path)
 
     images_path = []  # 存储所有图片路径
     images_label = []  # 存储图片对应索引信息
@@ -33,7 +63,11 @@ def read_dataset(ori_root: str, split: str):
     for cla in classes:
         cla_path = os.path.join(root, cla)
         # 遍历获取supported支持的所有文件路径
-        images = [os.path.join(root, cla, i) for i in os.listdir(cla_path)
+        if manifest is not None:
+            names = [name for name, is_dir, _ in manifest.listdir(cla_path) if not is_dir]
+        else:
+            names = os.listdir(cla_path)
+        images = [os.path.join(root, cla, i) for i in names
                   if os.path.splitext(i)[-1] in supported]
         # 排序，保证各平台顺序一致
         images.sort()
@@ -46,135 +80,111 @@ def read_dataset(ori_root: str, split: str):
             images_path.append(img_path)
             images_label.append(image_class)
 
+    if manifest is not None:
+        manifest.close()
+
     print("{} images were found in the dataset.".format(sum(every_class_num)))
     print("{} images for {}.".format(len(images_path), split))
     assert len(images_path) > 0, f"number of {split} images must greater than 0."
 
     return images_path, images_label
 
-def augment_and_pad(self, image, target_size):
-        # size transform
-        width, height = image.size
-        if width > height:
-            new_width = target_size
-            new_height = int(height * (target_size / width))
-        else:
-            new_height = target_size
-            new_width = int(width * (target_size / height))
-        
-        augment_transform = transforms.Compose([
-            transforms.Resize((new_height, new_width)),
+class LetterBox:
+    """
+    Reusable letterbox preprocessor: aspect-preserving resize to target_size, centered
+    zero padding, ToTensor and Normalize.
+
+    The resize/pad geometry is computed once per image and the normalization constants
+    once per object. Results are written straight into a (preallocated) output tensor and
+    match the former resize_and_pad / pad_ori / augment_and_pad functions pixel for pixel
+    (see benchmark.py --bench letterbox).
+
+    Args:
+        target_size (int) - output height and width
+        mean (list) - normalization mean per channel
+        std (list) - normalization std per channel
+    """
+
+    def __init__(self, target_size, mean, std):
+        self.target_size = target_size
+        self.channels = len(mean)
+        self.mean = torch.as_tensor(mean, dtype=torch.float32).view(-1, 1, 1)
+        self.std = torch.as_tensor(std, dtype=torch.float32).view(-1, 1, 1)
+        # padding部分归一化后的值
+        self.fill = (torch.zeros_like(self.mean) - self.mean) / self.std
+        self.augment_transform = transforms.Compose([
             transforms.RandomHorizontalFlip(p=0.5),
             transforms.RandomVerticalFlip(p=0.5),
             transforms.ColorJitter(brightness=(0.75, 1.5), contrast=(1.25, 1.75)),
             transforms.RandomRotation(20)
         ])
-        
-        augmented_image = augment_transform(image)
-        width, height = augmented_image.size
 
+    def geometry(self, width, height):
+        # 返回缩放后的(w, h)以及左上角padding (x0, y0)
         if width > height:
-            new_width = target_size
-            new_height = int(height * (target_size / width))
+            new_width = self.target_size
+            new_height = int(height * (self.target_size / width))
         else:
-            new_height = target_size
-            new_width = int(width * (target_size / height))
-        
-        pad_height1 = (target_size - new_width) // 2
-        pad_height2 = target_size - new_width - pad_height1
-        pad_width1 = (target_size - new_height) // 2
-        pad_width2 = target_size - new_height - pad_width1
-
-        transform = transforms.Compose([
-            transforms.Pad((pad_height1, pad_width1, pad_height2, pad_width2), fill=(0,)*self.channels),
-            transforms.ToTensor(),
-            transforms.Normalize(self.mean, self.std)
-        ])
-        
-        padded_image = transform(augmented_image)
-        
+            new_height = self.target_size
+            new_width = int(width * (self.target_size / height))
+        x0 = (self.target_size - new_width) // 2
+        y0 = (self.target_size - new_height) // 2
+        return new_width, new_height, x0, y0
+
+    def resize(self, image):
+        new_width, new_height, x0, y0 = self.geometry(*image.size)
+        if (new_width, new_height) != image.size:
+            image = image.resize((new_width, new_height), Image.BILINEAR)
+        return image, x0, y0
+
+    @staticmethod
+    def _to_uint8(image):
+        arr = torch.from_numpy(np.array(image, dtype=np.uint8))
+        if arr.ndim == 2:
+            arr = arr.unsqueeze(-1)
+        return arr.permute(2, 0, 1)
+
+    def pad_image(self, image):
+        # 等价于原来的pad_ori：返回padding后的PIL图像
+        image, x0, y0 = self.resize(image)
+        padded_image = Image.new(image.mode, (self.target_size, self.target_size), 0)
+        padded_image.paste(image, (x0, y0))
         return padded_image
 
-
-def resize_and_pad(image, target_size, mean, std, img_channel):
-    width, height = image.size
-
-    if width > height:
-        new_width = target_size
-        new_height = int(height * (target_size / width))
-    else:
-        new_height = target_size
-        new_width = int(width * (target_size / height))
-    
-    transform = transforms.Compose([
-        transforms.Resize((new_height, new_width)),
-    ])
-    
-    image = transform(image)
-    
-    width, height = image.size
-
-    if width > height:
-        new_width = target_size
-        new_height = int(height * (target_size / width))
-    else:
-        new_height = target_size
-        new_width = int(width * (target_size / height))
-    
-    pad_height1 = (target_size - new_width) // 2
-    pad_height2 = target_size - new_width - pad_height1
-    pad_width1 = (target_size - new_height) // 2
-    pad_width2 = target_size - new_height - pad_width1
-
-    transform = transforms.Compose([
-        transforms.Pad((pad_height1, pad_width1, pad_height2, pad_width2), fill=(0,)*img_channel),
-        transforms.ToTensor(),
-        transforms.Normalize(mean, std)
-    ])
-    
-    padded_image = transform(image)
-    
-    return padded_image
-
-
-def pad_ori(image, target_size, mean, std, img_channel):
-    width, height = image.size
-
-    if width > height:
-        new_width = target_size
-        new_height = int(height * (target_size / width))
-    else:
-        new_height = target_size
-        new_width = int(width * (target_size / height))
-    
-    transform = transforms.Compose([
-        transforms.Resize((new_height, new_width)),
-    ])
-    
-    image = transform(image)
-    
-    width, height = image.size
-
-    if width > height:
-        new_width = target_size
-        new_height = int(height * (target_size / width))
-    else:
-        new_height = target_size
-        new_width = int(width * (target_size / height))
-    
-    pad_height1 = (target_size - new_width) // 2
-    pad_height2 = target_size - new_width - pad_height1
-    pad_width1 = (target_size - new_height) // 2
-    pad_width2 = target_size - new_height - pad_width1
-
-    transform = transforms.Compose([
-        transforms.Pad((pad_height1, pad_width1, pad_height2, pad_width2), fill=(0,)*img_channel),
-    ])
-    
-    padded_image = transform(image)
-    
-    return padded_image
-
+    def to_uint8(self, image, out=None):
+        # 只做缩放和padding，返回uint8张量及内容区域(x0, y0, w, h)
+        image, x0, y0 = self.resize(image)
+        arr = self._to_uint8(image)
+        if out is None:
+            out = torch.zeros((arr.shape[0], self.target_size, self.target_size), dtype=torch.uint8)
+        else:
+            out.zero_()
+        out[:, y0:y0 + arr.shape[1], x0:x0 + arr.shape[2]] = arr
+        return out, torch.tensor([x0, y0, arr.shape[2], arr.shape[1]])
+
+    def __call__(self, image, out=None, augment=False):
+        image, x0, y0 = self.resize(image)
+        if augment:
+            image = self.augment_transform(image)
+        arr = self._to_uint8(image)
+        if out is None:
+            out = torch.empty((arr.shape[0], self.target_size, self.target_size), dtype=torch.float32)
+        out.copy_(self.fill.expand_as(out))
+        out[:, y0:y0 + arr.shape[1], x0:x0 + arr.shape[2]] = arr.float().div(255).sub_(self.mean).div_(self.std)
+        return out
+
+    def batch(self, images, device=None, out=None):
+        # 整个batch只做一次类型转换和归一化
+        canvas = torch.zeros((len(images), self.channels, self.target_size, self.target_size), dtype=torch.uint8)
+        for i, image in enumerate(images):
+            self.to_uint8(image, out=canvas[i])
+        if device is not None:
+            canvas = canvas.to(device, non_blocking=True)
+        mean, std = self.mean.to(canvas.device), self.std.to(canvas.device)
+        if out is None:
+            out = torch.empty(canvas.shape, dtype=torch.float32, device=canvas.device)
+        torch.div(canvas, 255, out=out)
+        return out.sub_(mean).div_(std)
 
 
 def create_lr_scheduler(
@@ -196,8 +206,9 @@ def create_lr_scheduler(
             # warmup过程中lr倍率因子从warmup_factor -> 1
             return warmup_factor * (1 - alpha) + alpha
         else:
-            current_step = (x - warmup_epochs * num_step)
             cosine_steps = (epochs - warmup_epochs) * num_step
+            # num_step只是估计值（如ShardDataSet多worker时），超出后停在end_factor
+            current_step = min(x - warmup_epochs * num_step, cosine_steps)
             # warmup后lr倍率因子从1 -> end_factor
             return ((1 + math.cos(current_step * math.pi / cosine_steps)) / 2) * (1 - end_factor) + end_factor
 
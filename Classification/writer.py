@@ -0,0 +1,77 @@
+import atexit
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+
+class AsyncWriter:
+    """
+    Asynchronous output writer with a bounded queue.
+
+    Encoding and writing (PIL Image.save, cv2.imwrite, or any picklable function) run
+    on a thread or process pool so the main loop keeps the GPU busy. submit() blocks once
+    max_queue jobs are pending. All jobs are flushed by close(), on leaving a `with`
+    block, or at interpreter exit; the first error raised by a job is re-raised there.
+
+    Args:
+        num_workers (int) - pool size, 0 writes synchronously
+        max_queue (int) - max number of pending jobs
+        use_processes (bool) - use a process pool instead of threads
+    """
+
+    def __init__(self, num_workers: int = 4, max_queue: int = 64, use_processes: bool = False):
+        self.num_workers = num_workers
+        self.pool = None
+        if num_workers > 0:
+            executor = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+            self.pool = executor(max_workers=num_workers)
+        self.slots = threading.BoundedSemaphore(max(max_queue, 1))
+        self.error = None
+        atexit.register(self.close)
+
+    def _done(self, future):
+        self.slots.release()
+        if future.exception() is not None and self.error is None:
+            self.error = future.exception()
+
+    def submit(self, fn, *args, **kwargs):
+        if self.error is not None:
+            raise self.error
+        if self.pool is None:
+            fn(*args, **kwargs)
+            return
+        self.slots.acquire()
+        future = self.pool.submit(fn, *args, **kwargs)
+        future.add_done_callback(self._done)
+
+    def save_image(self, image, path):
+        # PIL图像，按扩展名编码
+        self.submit(_save_image, image, path)
+
+    def imwrite(self, path, image):
+        # cv2 (BGR) 图像
+        self.submit(_imwrite, path, image)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+            self.pool = None
+        atexit.unregister(self.close)
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+
+def _save_image(image, path):
+    image.save(path)
+
+
+def _imwrite(path, image):
+    import cv2
+    if not cv2.imwrite(path, image):
+        raise IOError("failed to write {}".format(path))
@@ -0,0 +1,305 @@
+import os
+import sys
+import csv
+from multiprocessing import Pool
+
+import cv2
+import numpy as np
+
+# 与Classification共用异步写图工具
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "Classification"))
+from writer import AsyncWriter
+
+
+def largest_component(mask):
+    """
+    Keep the largest connected region of a predicted mask.
+
+    The region is chosen like the original loop: the outer contour with the largest
+    cv2.contourArea (hole contours are always smaller than the contour enclosing them, so
+    RETR_EXTERNAL finds the same one as RETR_LIST). All other regions are removed in one
+    pass through the connectedComponentsWithStats label image instead of filling every
+    other contour separately.
+
+    Args:
+        mask (np.ndarray) - HxW uint8 prediction, non-zero is foreground
+    Returns:
+        mask (np.ndarray) - HxW uint8, the input values inside the kept region, 0 elsewhere
+        contour (np.ndarray) - outer contour of the kept region
+    """
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+    areas = np.array([cv2.contourArea(c) for c in contours])
+    contour = contours[np.argmax(areas)]
+
+    num_labels, labels, stats, _ = cv2.connectedComponentsWithStats((mask > 0).astype(np.uint8), connectivity=8)
+    # 轮廓上的点都属于该连通域
+    x, y = contour[0, 0]
+    keep = labels == labels[y, x]
+    return mask * keep.astype(mask.dtype), contour
+
+
+def find_corners(contour, epsilon=0.05):
+    """
+    Approximate the region by a polygon and pick its four corner points.
+
+    Upper left / lower right are the first / last entry of np.argsort over x+y, upper
+    right / lower left those over y-x. The default argsort kind is not stable, so ties are
+    broken exactly like the original per-key sort, argmin / argmax would pick other
+    vertices on ties.
+
+    Returns:
+        corners (np.ndarray) - 4x2 [upper_left, lower_right, upper_right, lower_left]
+    """
+    cnt_len = cv2.arcLength(contour, True)
+    cnt = cv2.approxPolyDP(contour, epsilon * cnt_len, True).reshape(-1, 2)
+
+    keys = np.stack([cnt[:, 1] + cnt[:, 0], cnt[:, 1] - cnt[:, 0]])
+    order = np.argsort(keys, axis=1)
+    first, last = order[:, 0], order[:, -1]
+    return cnt[[first[0], last[0], first[1], last[1]]]
+
+
+def check_corners(corners):
+    # 四个角点的相对位置不合理时需要人工检查，返回每一项检查的结果
+    upper_left, lower_right, upper_right, lower_left = corners
+    return [upper_left[1] > lower_left[1] or upper_left[1] > lower_right[1],
+            upper_right[1] > lower_left[1] or upper_right[1] > lower_right[1],
+            upper_right[0] < lower_left[0] or upper_right[0] < upper_left[0],
+            lower_right[0] < lower_left[0] or lower_right[0] < upper_left[0]]
+
+
+def corner_distances(corners):
+    """
+    Centers and left / right edge lengths for a batch of corner sets.
+
+    Args:
+        corners (np.ndarray) - Bx4x2 from find_corners
+    Returns:
+        centers (np.ndarray) - Bx2 mean x, y of the corners
+        left_distance (np.ndarray) - B, |lower_left - upper_left|
+        right_distance (np.ndarray) - B, |lower_right - upper_right|
+    """
+    corners = np.asarray(corners).reshape(-1, 4, 2)
+    centers = corners.mean(axis=1)
+    left_distance = np.linalg.norm((corners[:, 3] - corners[:, 0]).astype(np.float64), axis=-1)
+    right_distance = np.linalg.norm((corners[:, 1] - corners[:, 2]).astype(np.float64), axis=-1)
+    return centers, left_distance, right_distance
+
+
+def to_mask(prediction):
+    """
+    Convert a prediction array to a HxW uint8 mask.
+
+    Args:
+        prediction (np.ndarray) - label mask (integer / bool dtype, HxW or with singleton
+            axes), or CxHxW / Cx1xHxW float class probabilities (nnU-Net softmax), reduced
+            with argmax over C
+    """
+    prediction = np.asarray(prediction)
+    if np.issubdtype(prediction.dtype, np.floating):
+        prediction = prediction.argmax(axis=0)
+    prediction = prediction.squeeze()
+    if prediction.ndim != 2:
+        raise ValueError("expected a 2D mask, got shape {}".format(prediction.shape))
+    return np.ascontiguousarray(prediction, dtype=np.uint8)
+
+
+def load_prediction(path, key="probabilities"):
+    # .png: nnU-Net分割结果，直接按单通道读取；.npz: --save_probabilities保存的softmax；.npy: 内存映射读取
+    if path.endswith(".npz"):
+        with np.load(path) as data:
+            return to_mask(data[key] if key in data.files else data[data.files[0]])
+    if path.endswith(".npy"):
+        return to_mask(np.load(path, mmap_mode="r"))
+    return cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+
+
+def analyze_mask(mask):
+    """
+    Largest region and corners of one prediction.
+
+    Args:
+        mask (np.ndarray) - prediction accepted by to_mask
+    Returns:
+        mask (np.ndarray) - HxW uint8 mask of the kept region
+        corners (np.ndarray) - 4x2 [upper_left, lower_right, upper_right, lower_left]
+    """
+    mask, contour = largest_component(to_mask(mask))
+    return mask, find_corners(contour)
+
+
+def analyze_predictions(predictions, names=None):
+    """
+    Corner and distance metadata for in-memory predictions, without writing PNGs.
+
+    Args:
+        predictions (iterable) - masks or softmax arrays, see to_mask
+        names (list) - image names, defaults to the running index
+    Returns:
+        list of dicts with img_name, corners, checks, center_x, center_y, left_distance
+        and right_distance (the distance.csv columns)
+    """
+    corners = [analyze_mask(prediction)[1] for prediction in predictions]
+    if names is None:
+        names = [str(k) for k in range(len(corners))]
+    if len(corners) == 0:
+        return []
+    centers, left_distance, right_distance = corner_distances(np.stack(corners))
+    return [dict(img_name=names[k], corners=corners[k], checks=check_corners(corners[k]),
+                 center_x=float(centers[k, 0]), center_y=float(centers[k, 1]),
+                 left_distance=float(left_distance[k]), right_distance=float(right_distance[k]))
+            for k in range(len(corners))]
+
+
+def case_name(path, suffix="_0000"):
+    # nnU-Net命名：图像为 <case>_0000.png，预测为 <case>.png
+    name = os.path.splitext(os.path.split(path)[-1])[0]
+    if name.endswith(suffix):
+        name = name[:-len(suffix)]
+    return name
+
+
+def pair_cases(img_dir, pdt_dir, pdt_suffix=".png"):
+    """Pair images and predictions (files ending with pdt_suffix) by case name, sorted by case name."""
+    images = dict((case_name(item.path), item.path) for item in os.scandir(img_dir) if item.is_file())
+    predicts = dict((case_name(item.path), item.path) for item in os.scandir(pdt_dir)
+                    if item.is_file() and item.name.endswith(pdt_suffix))
+    for case in sorted(set(images) ^ set(predicts)):
+        print("missing", "prediction" if case in images else "image", "for", case)
+    return [(case, images[case], predicts[case]) for case in sorted(set(images) & set(predicts))]
+
+
+def visualize(img, res, corners):
+    # 预测区域叠加为红色，角点画成白色圆点
+    res = cv2.cvtColor(res, cv2.COLOR_GRAY2BGR)
+    vis = img + res * (0, 0, 75)
+    vis = np.uint8(vis)
+    for pnt in corners :
+        cv2.circle(vis, pnt, 3, (255, 255, 255), 3)
+        cv2.circle(img, pnt, 3, (255, 255, 255), 3)
+    return vis, img
+
+
+def save_visualization(image_path, res, corners, vis_dir, image_name):
+    # 在AsyncWriter的线程中读取原图、叠加并编码PNG
+    vis, img = visualize(cv2.imread(image_path), res, corners)
+    for path, image in [(os.path.join(vis_dir, "vis_seg", f"{image_name}_vis_seg.png"), vis),
+                        (os.path.join(vis_dir, "vis_ori", f"{image_name}_vis_ori.png"), img)]:
+        if not cv2.imwrite(path, image):
+            raise IOError("failed to write {}".format(path))
+
+
+def process_case(job):
+    """
+    Post-process one prediction: largest region and corners.
+
+    Args:
+        job (tuple) - (case, image path, prediction path, keep_mask), keep_mask returns the
+            kept region for visualization
+    Returns:
+        (image_name, corners, checks, mask or None)
+    """
+    case, image_path, predict_path, keep_mask = job
+    image_name = os.path.split(image_path)[-1].split("_")[0]
+    res, corners = analyze_mask(load_prediction(predict_path))
+    return image_name, corners, check_corners(corners), res if keep_mask else None
+
+
+class DistanceWriter:
+    """
+    Streams corner metadata rows to distance.csv.
+
+    Rows are buffered in small batches so corner_distances stays vectorized. The file has
+    the same layout as pd.DataFrame(...).to_csv: an unnamed running index column followed
+    by img_name, center_x, center_y, left_distance and right_distance.
+
+    Args:
+        path (str) - output csv file
+        batch_size (int) - rows computed and written together
+    """
+
+    columns = ["img_name", "center_x", "center_y", "left_distance", "right_distance"]
+
+    def __init__(self, path, batch_size=64):
+        self.f = open(path, "w", newline="")
+        self.writer = csv.writer(self.f, lineterminator="\n")
+        self.writer.writerow([""] + self.columns)
+        self.batch_size = batch_size
+        self.names = []
+        self.corners = []
+        self.num_rows = 0
+
+    def add(self, image_name, corners):
+        self.names.append(image_name)
+        self.corners.append(corners)
+        if len(self.names) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.names) == 0:
+            return
+        centers, left_distance, right_distance = corner_distances(np.stack(self.corners))
+        for k in range(len(self.names)):
+            self.writer.writerow([self.num_rows, self.names[k], float(centers[k, 0]), float(centers[k, 1]),
+                                  float(left_distance[k]), float(right_distance[k])])
+            self.num_rows += 1
+        self.f.flush()
+        self.names = []
+        self.corners = []
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+
+def postprocess(img_dir, pdt_dir, out_dir="results", num_workers=4, save_vis=True, pdt_suffix=".png",
+                writer_workers=4):
+    """
+    Post-process an nnU-Net prediction folder and write <out_dir>/distance.csv.
+
+    Cases are processed on a process pool and their rows are written as soon as they
+    are done, in case name order. The visualization images are drawn, encoded and
+    written by an AsyncWriter (Classification/writer.py), so PNG encoding overlaps with
+    the analysis of the next cases.
+
+    Args:
+        img_dir (str) - nnU-Net input images, <case>_0000.png
+        pdt_dir (str) - nnU-Net predictions, <case>.png or softmax <case>.npz / .npy
+        out_dir (str) - output directory for distance.csv and the vis_seg / vis_ori images
+        num_workers (int) - pool size, 0 runs in this process
+        save_vis (bool) - write the visualization images
+        pdt_suffix (str) - prediction file type, ".png", ".npz" or ".npy"
+        writer_workers (int) - threads writing the visualization images, 0 to write synchronously
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    if save_vis:
+        os.makedirs(os.path.join(out_dir, "vis_seg"), exist_ok=True)
+        os.makedirs(os.path.join(out_dir, "vis_ori"), exist_ok=True)
+    cases = pair_cases(img_dir, pdt_dir, pdt_suffix)
+    jobs = [(case, image_path, predict_path, save_vis) for case, image_path, predict_path in cases]
+
+    pool = Pool(num_workers) if num_workers > 0 else None
+    results = pool.imap(process_case, jobs, chunksize=4) if pool is not None else map(process_case, jobs)
+    image_writer = AsyncWriter(num_workers=writer_workers)
+    try:
+        with DistanceWriter(os.path.join(out_dir, "distance.csv")) as writer:
+            for (case, image_path, _), (image_name, corners, checks, res) in zip(cases, results):
+                for failed in checks :
+                    if failed :
+                        print("check", image_name, "!!!")
+                upper_left, lower_right, upper_right, lower_left = corners
+                print(image_name, upper_left, upper_right, lower_left, lower_right)
+                writer.add(image_name, corners)
+                if res is not None:
+                    image_writer.submit(save_visualization, image_path, res, corners, out_dir, image_name)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        image_writer.close()
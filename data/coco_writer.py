@@ -0,0 +1,169 @@
+import os
+import json
+import shutil
+import tempfile
+from array import array
+
+INDEX_MAGIC = b"COCOIDX2"
+# 每张图像一行int64：image_id, 图像记录offset, 长度, 标注offset, 长度, 标注数, 最大标注id
+INDEX_COLUMNS = 7
+
+
+def _dumps(obj):
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def index_path(json_path):
+    # annotation_coco_train.json -> annotation_coco_train.idx
+    return os.path.splitext(json_path)[0] + ".idx"
+
+
+def has_index(json_path):
+    # json和当前格式的.idx都存在时才能从旧文件增量更新
+    if not os.path.exists(json_path) or not os.path.exists(index_path(json_path)):
+        return False
+    with open(index_path(json_path), "rb") as f:
+        return f.read(len(INDEX_MAGIC)) == INDEX_MAGIC
+
+
+class CocoWriter:
+    """
+    Streaming writer for compact COCO annotation files.
+
+    Images are written to the json file as they are added, their annotations go to a
+    temporary spool file that is appended after the images on close(), so memory use does
+    not grow with the split. The file is written to <path>.tmp and moved into place on
+    close(). With index=True a binary sidecar (<name>.idx) is written as well: a magic
+    header followed by int64 rows (image_id, image byte offset, image byte length,
+    annotations byte offset, annotations byte length, num annotations, max annotation id)
+    pointing at the records of every image inside the json file, see CocoIndex.
+
+    Args:
+        path (str) - output json file
+        categories (list) - COCO categories
+        index (bool) - also write the .idx sidecar
+    """
+
+    def __init__(self, path: str, categories: list, index: bool = False):
+        self.path = path
+        self.categories = categories
+        self.tmp_path = path + ".tmp"
+        self.f = open(self.tmp_path, "wb")
+        self.spool = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(path)))
+        self.index = [] if index else None
+        self.num_images = 0
+        self.num_annotations = 0
+        self.f.write(b'{"images":[')
+
+    def add(self, image, annotations):
+        if self.num_images > 0:
+            self.f.write(b",")
+        image_start = self.f.tell()
+        self.f.write(_dumps(image))
+        image_end = self.f.tell()
+        self.num_images += 1
+
+        start = end = self.spool.tell() + (1 if self.num_annotations > 0 else 0)
+        for anno in annotations:
+            if self.num_annotations > 0:
+                self.spool.write(b",")
+            self.spool.write(_dumps(anno))
+            self.num_annotations += 1
+            end = self.spool.tell()
+        if self.index is not None:
+            max_id = max((anno["id"] for anno in annotations), default=-1)
+            self.index.append((image["id"], image_start, image_end - image_start, start, end - start,
+                               len(annotations), max_id))
+
+    def close(self):
+        self.f.write(b'],"annotations":[')
+        base = self.f.tell()
+        self.spool.seek(0)
+        shutil.copyfileobj(self.spool, self.f, 1 << 20)
+        self.spool.close()
+        self.f.write(b'],"categories":' + _dumps(self.categories) + b'}')
+        self.f.close()
+        # 先删除旧索引，避免中途退出时新json与旧索引配对
+        if os.path.exists(index_path(self.path)):
+            os.remove(index_path(self.path))
+        os.replace(self.tmp_path, self.path)
+
+        if self.index is not None:
+            rows = array("q")
+            for image_id, image_offset, image_length, offset, length, count, max_id in self.index:
+                rows.extend((image_id, image_offset, image_length, offset + base, length, count, max_id))
+            tmp_path = index_path(self.path) + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(INDEX_MAGIC)
+                rows.tofile(f)
+            os.replace(tmp_path, index_path(self.path))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.f.close()
+            self.spool.close()
+            os.remove(self.tmp_path)
+
+
+class CocoIndex:
+    """
+    Lazy image / annotation lookup through the .idx sidecar written by CocoWriter.
+
+    Only the requested byte range of the json file is read and parsed, so an existing
+    annotation file can be streamed record by record (e.g. for incremental updates).
+
+    Args:
+        json_path (str) - annotation json written by CocoWriter(index=True)
+    """
+
+    def __init__(self, json_path: str):
+        self.json_path = json_path
+        with open(index_path(json_path), "rb") as f:
+            if f.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                raise ValueError("not a COCO annotation index: {}".format(index_path(json_path)))
+            rows = array("q", f.read())
+        self.rows = dict((rows[i], tuple(rows[i + 1:i + INDEX_COLUMNS])) for i in range(0, len(rows), INDEX_COLUMNS))
+        self.f = None
+
+    @property
+    def image_ids(self):
+        return list(self.rows.keys())
+
+    def num_annotations(self, image_id):
+        return self.rows[image_id][4]
+
+    def max_annotation_id(self, image_ids=None):
+        image_ids = self.rows.keys() if image_ids is None else image_ids
+        return max((self.rows[image_id][5] for image_id in image_ids), default=-1)
+
+    def _read(self, offset, length):
+        if self.f is None:
+            self.f = open(self.json_path, "rb")
+        self.f.seek(offset)
+        return self.f.read(length)
+
+    def image(self, image_id):
+        offset, length = self.rows[image_id][:2]
+        return json.loads(self._read(offset, length))
+
+    def annotations(self, image_id):
+        offset, length = self.rows[image_id][2:4]
+        if length == 0:
+            return []
+        return json.loads(b"[" + self._read(offset, length) + b"]")
+
+    def __getstate__(self):
+        # DataLoader worker中重新打开文件
+        state = self.__dict__.copy()
+        state["f"] = None
+        return state
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
@@ -0,0 +1,89 @@
+import os
+import json
+import shutil
+from multiprocessing import Pool
+
+from PIL import Image
+
+# linux ioctl FICLONE：在btrfs/xfs等文件系统上做写时复制（reflink）
+FICLONE = 0x40049409
+
+
+def run_jobs(fn, jobs, num_workers=None, chunksize=4):
+    """
+    Run fn over jobs on a process pool and return the results in job order.
+
+    Args:
+        fn (callable) - module level function taking one job
+        jobs (list) - picklable jobs
+        num_workers (int) - pool size, None for os.cpu_count(), 0 runs in this process
+    """
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    if num_workers == 0 or len(jobs) <= 1:
+        return [fn(job) for job in jobs]
+    with Pool(min(num_workers, len(jobs))) as pool:
+        return pool.map(fn, jobs, chunksize=chunksize)
+
+
+def iter_jobs(fn, jobs, num_workers=None, chunksize=4):
+    # 与run_jobs相同，但按顺序逐个产出结果，不在内存中保留全部结果
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    if num_workers == 0 or len(jobs) <= 1:
+        for job in jobs:
+            yield fn(job)
+        return
+    with Pool(min(num_workers, len(jobs))) as pool:
+        for result in pool.imap(fn, jobs, chunksize=chunksize):
+            yield result
+
+
+def image_size(path):
+    # 只读取文件头得到 (height, width)，与cv2.imread(path).shape[:2]一致
+    # cv2.imread会按EXIF方向旋转图像，方向为5-8时宽高互换
+    with Image.open(path) as img:
+        width, height = img.size
+        orientation = img.getexif().get(0x0112, 1)
+    if orientation in (5, 6, 7, 8):
+        width, height = height, width
+    return height, width
+
+
+def link_or_copy(src, dst):
+    # 依次尝试reflink、硬链接，都不支持时退回shutil.copy，输出内容完全相同
+    if os.path.abspath(src) == os.path.abspath(dst):
+        return
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        import fcntl
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        shutil.copymode(src, dst)
+        return
+    except (ImportError, OSError):
+        if os.path.exists(dst):
+            os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
+
+
+def copy_labelme_pair(job):
+    # 检测任务：复制图像并读取labelme标注，返回 (height, width, shapes)
+    img_path, label_path, dst_path = job
+    link_or_copy(img_path, dst_path)
+    height, width = image_size(img_path)
+    with open(label_path, "r") as f:
+        labels = json.load(f)
+    return height, width, labels["shapes"]
+
+
+def save_crops(job):
+    # 分类任务：crops为 [(box, 保存路径)]，box已在主进程中按原逻辑计算好
+    img_path, crops = job
+    with Image.open(img_path) as image:
+        for box, path in crops:
+            image.crop(box).save(path)
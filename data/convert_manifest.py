@@ -0,0 +1,104 @@
+import os
+import json
+import hashlib
+
+
+class ConversionManifest:
+    """
+    Source manifest for incremental labelme conversion.
+
+    Stored as <out_file>/.convert_manifest.json. It records the split of every patient
+    (or external image) the first time it is seen, so new annotation batches never move
+    existing patients between train / val / test, and for every converted labelme pair
+    its split, image id and content hash. sync() compares the current sources with the
+    manifest and returns only the pairs that were added or changed, together with the
+    records whose outputs have to be removed. Files are only re-hashed when their size
+    or mtime changed.
+
+    Args:
+        out_file (str) - output dataset directory
+    """
+
+    def __init__(self, out_file: str, name: str = ".convert_manifest.json"):
+        self.path = os.path.join(out_file, name)
+        self.splits = {}
+        self.sources = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                manifest = json.load(f)
+            self.splits = manifest["splits"]
+            self.sources = manifest["sources"]
+        # 没有manifest时（第一次转换或旧版本的输出）全部重新生成
+        self.fresh = len(self.sources) == 0
+
+    def assign(self, key, split):
+        # 已有的病人沿用第一次的划分
+        return self.splits.setdefault(key, split)
+
+    @staticmethod
+    def _stat(paths):
+        return [[os.stat(p).st_size, os.stat(p).st_mtime_ns] for p in paths]
+
+    @staticmethod
+    def _hash(paths):
+        h = hashlib.sha1()
+        for p in paths:
+            with open(p, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    h.update(chunk)
+        return h.hexdigest()
+
+    def sync(self, items):
+        """
+        Compare the current sources with the manifest.
+
+        Args:
+            items (list) - dicts with key, paths (image and labelme json), split and
+                default_id (id used when the key is new and the id is still free)
+        Returns:
+            changed (list) - new or modified items, each with its image "id" filled in
+            stale (list) - previous records of changed and removed items
+        """
+        keys = set(item["key"] for item in items)
+        stale = [dict(record, key=key) for key, record in self.sources.items() if key not in keys]
+        changed = []
+        for item in items:
+            record = self.sources.get(item["key"])
+            stat = self._stat(item["paths"])
+            if record is not None and record["split"] == item["split"]:
+                if record["stat"] == stat:
+                    continue
+                file_hash = self._hash(item["paths"])
+                if record["hash"] == file_hash:
+                    record["stat"] = stat
+                    continue
+            else:
+                file_hash = self._hash(item["paths"])
+            if record is not None:
+                stale.append(dict(record, key=item["key"]))
+            changed.append(dict(item, id=None if record is None else record["id"], stat=stat, hash=file_hash))
+
+        # 新图像优先使用原来的编号（按文件排序的下标），被占用时顺延
+        used = set(record["id"] for key, record in self.sources.items() if key in keys)
+        next_id = max(used | set(item["default_id"] for item in items), default=-1) + 1
+        for item in changed:
+            if item["id"] is None:
+                if item["default_id"] not in used:
+                    item["id"] = item["default_id"]
+                else:
+                    item["id"] = next_id
+                    next_id += 1
+                used.add(item["id"])
+        return changed, stale
+
+    def update(self, changed, stale):
+        for record in stale:
+            self.sources.pop(record["key"], None)
+        for item in changed:
+            self.sources[item["key"]] = dict(split=item["split"], id=item["id"], stat=item["stat"], hash=item["hash"])
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(dict(splits=self.splits, sources=self.sources), f)
+        os.replace(tmp_path, self.path)
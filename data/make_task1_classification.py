@@ -1,14 +1,14 @@
-import shutil
 import os
-import cv2
 import json
 import random
 import pandas as pd
 import numpy as np
 from PIL import Image
+from pack_shards import pack_dataset
+from convert_engine import run_jobs, save_crops as save_crop_jobs
 # import albumentations as A
 
-def crop_image_from_labelme(raw_file, external_file, out_file):
+def crop_image_from_labelme(raw_file, external_file, out_file, pack=False, save_crops=True, num_workers=None):
     os.makedirs(out_file, exist_ok=True)
     files = [item.path for item in os.scandir(raw_file) if item.is_file()]
     img_files = [f for f in files if f.endswith("jpg")]
@@ -61,6 +61,9 @@ def crop_image_from_labelme(raw_file, external_file, out_file):
     # for split in ["fold1", "fold2", "fold3", "fold4", "fold5", "test"] :
         os.makedirs(os.path.join(out_file, split, "Y"), exist_ok=True)
         os.makedirs(os.path.join(out_file, split, "N"), exist_ok=True)
+        rois = []
+        # 裁剪框（含随机位移）仍在主进程按原顺序计算，保证与原随机数序列一致；裁剪和保存在进程池中完成
+        jobs = []
 
         for i in range(len(img_files)) :
             filename = os.path.split(img_files[i])[-1]
@@ -68,6 +71,8 @@ def crop_image_from_labelme(raw_file, external_file, out_file):
                 continue
             
             image = Image.open(img_files[i])
+            crops = []
+            jobs.append((img_files[i], crops))
             
             with open(label_files[i], "r") as f:
                 labels = json.load(f)
@@ -94,9 +99,13 @@ def crop_image_from_labelme(raw_file, external_file, out_file):
                 
                 category = label["label"]
                 
-                img_crop = image.crop((x_min, y_min, x_max, y_max))
-                
-                img_crop.save(os.path.join(out_file, split, category, f"{filename.split('.')[0]}_{j}.jpg"))
+                # save_crops=False时只记录ROI，位移裁剪由Classification/dataset.py中的ROIDataSet在训练时生成
+                if not save_crops :
+                    rois.append(dict(image=os.path.abspath(img_files[i]), box=[x_min, y_min, x_max, y_max], label=category,
+                                     delta=[x_delta, y_delta], aug_size=0 if split == "test" else (6 if category == "Y" else 1)))
+                    continue
+
+                crops.append(((x_min, y_min, x_max, y_max), os.path.join(out_file, split, category, f"{filename.split('.')[0]}_{j}.jpg")))
                 
                 if split == "test" :
                     continue
@@ -120,9 +129,7 @@ def crop_image_from_labelme(raw_file, external_file, out_file):
                     if yy_min >= image.width :
                         yy_min = image.width-1
                 
-                    img_crop = image.crop((xx_min, yy_min, xx_max, yy_max))
-                    
-                    img_crop.save(os.path.join(out_file, split, category, f"{filename.split('.')[0]}_{j}_aug{k+1}.jpg"))
+                    crops.append(((xx_min, yy_min, xx_max, yy_max), os.path.join(out_file, split, category, f"{filename.split('.')[0]}_{j}_aug{k+1}.jpg")))
         
         for i in range(len(img_external)) :
             filename = os.path.split(img_external[i])[-1]
@@ -130,6 +137,8 @@ def crop_image_from_labelme(raw_file, external_file, out_file):
                 continue
             
             image = Image.open(img_external[i])
+            crops = []
+            jobs.append((img_external[i], crops))
             
             with open(label_external[i], "r") as f:
                 labels = json.load(f)
@@ -156,9 +165,13 @@ def crop_image_from_labelme(raw_file, external_file, out_file):
                 
                 category = label["label"]
                 
-                img_crop = image.crop((x_min, y_min, x_max, y_max))
-                
-                img_crop.save(os.path.join(out_file, split, category, f"{filename.split('.')[0]}_{j}.jpg"))
+                # save_crops=False时只记录ROI，位移裁剪由Classification/dataset.py中的ROIDataSet在训练时生成
+                if not save_crops :
+                    rois.append(dict(image=os.path.abspath(img_external[i]), box=[x_min, y_min, x_max, y_max], label=category,
+                                     delta=[x_delta, y_delta], aug_size=2))
+                    continue
+
+                crops.append(((x_min, y_min, x_max, y_max), os.path.join(out_file, split, category, f"{filename.split('.')[0]}_{j}.jpg")))
                 
                 if category == "Y" :
                     aug_size = 2
@@ -179,9 +192,17 @@ def crop_image_from_labelme(raw_file, external_file, out_file):
                     if yy_min >= image.width :
                         yy_min = image.width-1
                 
-                    img_crop = image.crop((xx_min, yy_min, xx_max, yy_max))
-                    
-                    img_crop.save(os.path.join(out_file, split, category, f"{filename.split('.')[0]}_{j}_aug{k+1}.jpg"))
+                    crops.append(((xx_min, yy_min, xx_max, yy_max), os.path.join(out_file, split, category, f"{filename.split('.')[0]}_{j}_aug{k+1}.jpg")))
+
+        if save_crops :
+            run_jobs(save_crop_jobs, jobs, num_workers)
+        else :
+            with open(os.path.join(out_file, f"{split}_rois.json"), "w") as f:
+                json.dump(rois, f)
+
+    # 可选：每个split打包成若干大tar分片，配合Classification/train.py --shard_dir使用
+    if pack :
+        pack_dataset(out_file, out_file + "_shards")
 
 
 if __name__ == '__main__':
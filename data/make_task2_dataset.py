@@ -2,13 +2,26 @@ import json
 import os
 import os.path as osp
 import PIL.Image
-import shutil
 import pandas as pd
 import random
 from labelme import utils
-import cv2
+from convert_engine import run_jobs, image_size
+from convert_manifest import ConversionManifest
 
-def convert_labelme_to_nnunet(raw_file, out_file):
+
+def convert_case(job):
+    img_file, label_file, image_path, label_path = job
+    data = json.load(open(label_file))
+    # lbl为label图片（标注的地方用类别名对应的数字来标，其他为0）lbl_names为label名和数字的对应关系字典
+    # 图像尺寸只从文件头读取，不再为此完整解码一次
+    lbl, lbl_names = utils.shape.labelme_shapes_to_label(image_size(img_file), data['shapes'])   # data['shapes']是json文件中记录着标注的位置及label等信息的字段
+
+    img = PIL.Image.open(img_file).convert("L")
+    img.save(image_path)
+    PIL.Image.fromarray(lbl).save(label_path)
+
+
+def convert_labelme_to_nnunet(raw_file, out_file, num_workers=None):
     os.makedirs(f"{out_file}/imagesTr", exist_ok=True)
     os.makedirs(f"{out_file}/imagesTs", exist_ok=True)
     os.makedirs(f"{out_file}/labelsTr", exist_ok=True)
@@ -33,38 +46,49 @@ def convert_labelme_to_nnunet(raw_file, out_file):
     img_files.sort()
     label_files.sort()
 
-    # make final split
-    train_split = []
-    val_split = []
+    # 增量转换：病人的划分记录在manifest中，已有的保持不变；只处理新增或修改过的labelme对
+    manifest = ConversionManifest(out_file)
+    sources = []
     for i in range(len(img_files)):
-        filename = os.path.split(img_files[i])[-1].split(".")[0]
-        if filename.split("R")[0][1:] in train :
-            train_split.append(filename)
-        if filename.split("R")[0][1:] in val :
-            val_split.append(filename)
+        filename = os.path.split(label_files[i])[-1].split(".")[0]    # 提取出.json前的字符作为文件名，以便后续保存Label图片的时候使用
+        pid = filename.split("R")[0][1:]
+        if pid in train :
+            split = "train"
+        elif pid in val :
+            split = "val"
+        else :
+            split = "test"
+        split = manifest.assign(f"patient/{pid}", split)
+        sources.append(dict(key=filename, paths=[img_files[i], label_files[i]], split=split, default_id=i))
+    changed, stale = manifest.sync(sources)
+    removed = set(record["key"] for record in stale) - set(item["key"] for item in changed)
+    print(f"{len(changed)} cases added or changed, {len(removed)} removed")
+
+    # make final split
+    train_split = [item["key"] for item in sources if item["split"] == "train"]
+    val_split = [item["key"] for item in sources if item["split"] == "val"]
     split_json = 5 * [{"train":train_split, "val":val_split}]
     with open(f"{out_file}/splits_final.json","w") as f:
         json.dump(split_json, f, indent=4)
 
-    train_num = 0
-    val_num = 0
-    for i in range(len(img_files)):
-        filename = os.path.split(label_files[i])[-1].split(".")[0]    # 提取出.json前的字符作为文件名，以便后续保存Label图片的时候使用
-        if filename.split("R")[0][1:] in train :
-            train_num += 1
-            split = "Tr"
-        elif filename.split("R")[0][1:] in val :
-            val_num += 1
-            split = "Tr"
-        else :
-            split = "Ts"
-        data = json.load(open(label_files[i]))
-        # lbl为label图片（标注的地方用类别名对应的数字来标，其他为0）lbl_names为label名和数字的对应关系字典
-        lbl, lbl_names = utils.shape.labelme_shapes_to_label(cv2.imread(img_files[i]).shape[:2], data['shapes'])   # data['shapes']是json文件中记录着标注的位置及label等信息的字段
+    folder = {"train": "Tr", "val": "Tr", "test": "Ts"}
+    for record in stale :
+        for path in [os.path.join(out_file, f"images{folder[record['split']]}", f"{record['key']}_0000.png"),
+                     osp.join(out_file, f"labels{folder[record['split']]}", '{}.png'.format(record['key']))] :
+            if os.path.exists(path) :
+                os.remove(path)
 
-        img = PIL.Image.open(img_files[i]).convert("L")
-        img.save(os.path.join(out_file, f"images{split}", f"{filename}_0000.png"))
-        PIL.Image.fromarray(lbl).save(osp.join(out_file, f"labels{split}", '{}.png'.format(filename)))
+    jobs = []
+    for item in changed :
+        split = folder[item["split"]]
+        jobs.append((item["paths"][0], item["paths"][1],
+                     os.path.join(out_file, f"images{split}", f"{item['key']}_0000.png"),
+                     osp.join(out_file, f"labels{split}", '{}.png'.format(item["key"]))))
+    run_jobs(convert_case, jobs, num_workers)
+    manifest.update(changed, stale)
+    manifest.save()
+    train_num = len(train_split)
+    val_num = len(val_split)
     
     dataset_json = {
         "channel_names": {
@@ -1,12 +1,13 @@
-import shutil
 import os
-import cv2
-import json
+import heapq
 import random
 import pandas as pd
 import numpy as np
+from convert_engine import iter_jobs, copy_labelme_pair
+from convert_manifest import ConversionManifest
+from coco_writer import CocoWriter, CocoIndex, has_index
 
-def convert_labelme_to_coco(raw_file, out_file):
+def convert_labelme_to_coco(raw_file, out_file, num_workers=None, index=True):
     os.makedirs(out_file, exist_ok=True)
     files = [item.path for item in os.scandir(raw_file) if item.is_file()]
     img_files = [f for f in files if f.endswith("jpg")]
@@ -28,64 +29,105 @@ def convert_labelme_to_coco(raw_file, out_file):
     print(test)
     
     split_compose = {"train":train, "val":val, "test":test}
+    # 增量转换：病人的划分记录在manifest中，已有的保持不变；只处理新增或修改过的labelme对
+    manifest = ConversionManifest(out_file)
+    sources = []
+    for i in range(len(img_files)) :
+        filename = os.path.split(img_files[i])[-1]
+        pid = filename.split("R")[0][1:]
+        splits = [split for split in ["train", "val", "test"] if pid in split_compose[split]]
+        if len(splits) == 0 :
+            continue
+        split = manifest.assign(f"patient/{pid}", splits[0])
+        sources.append(dict(key=filename, paths=[img_files[i], label_files[i]], split=split, default_id=i))
+    changed, stale = manifest.sync(sources)
+    removed = set(record["key"] for record in stale) - set(item["key"] for item in changed)
+    print(f"{len(changed)} images added or changed, {len(removed)} removed")
+
     for split in ["train", "val", "test"] :
         os.makedirs(os.path.join(out_file, split), exist_ok=True)
+        split_changed = [item for item in changed if item["split"] == split]
+        # 增量更新需要旧的json和.idx；缺失时（被删除或index=False）整个划分重新生成，未修改的图像沿用manifest中的编号
+        fresh = manifest.fresh or not has_index(os.path.join(out_file, f"annotation_coco_{split}.json"))
+        if fresh and not manifest.fresh :
+            changed_keys = set(item["key"] for item in split_changed)
+            split_changed += [dict(item, id=manifest.sources[item["key"]]["id"]) for item in sources
+                              if item["split"] == split and item["key"] not in changed_keys]
+        update_coco_split(out_file, split, fresh, split_changed,
+                          [record for record in stale if record["split"] == split], num_workers, index)
+
+    manifest.update(changed, stale)
+    manifest.save()
+
 
-        annotations = []
-        images = []
-        obj_count = 0
+def coco_annotations(image_id, shapes, obj_count):
+    annotations = []
+    for label in shapes :
+    
+        x1 = label["points"][0][0]
+        x2 = label["points"][1][0]
+        y1 = label["points"][0][1]
+        y2 = label["points"][1][1]
         
-        for i in range(len(img_files)) :
-            filename = os.path.split(img_files[i])[-1]
-            if filename.split("R")[0][1:] not in split_compose[split] :
-                continue
-            shutil.copy(img_files[i], os.path.join(out_file, split, os.path.split(img_files[i])[-1]))
-            height, width = cv2.imread(img_files[i]).shape[:2]
+        x_min = int(min(x1, x2))
+        x_max = int(max(x1, x2))
+        y_min = int(min(y1, y2))
+        y_max = int(max(y1, y2))
+        
+        poly = [x1, y1, x2, y1, x2, y2, x1, y2]
+        
+        # cat_id = 1 if label["label"] == "Y" else 0
+        cat_id = 0
+    
+        data_anno = dict(
+            image_id=image_id,
+            id=obj_count,
+            category_id=cat_id,
+            bbox=[x_min, y_min, x_max - x_min, y_max - y_min],
+            area=(x_max - x_min) * (y_max - y_min),
+            segmentation=[poly],
+            iscrowd=0)
+        annotations.append(data_anno)
+        obj_count += 1
+    return annotations
 
-            images.append(
-                dict(id=i, file_name=filename, height=height, width=width))
 
-            with open(label_files[i], "r") as f:
-                labels = json.load(f)
-                
-            for label in labels["shapes"] :
-            
-                x1 = label["points"][0][0]
-                x2 = label["points"][1][0]
-                y1 = label["points"][0][1]
-                y2 = label["points"][1][1]
-                
-                x_min = int(min(x1, x2))
-                x_max = int(max(x1, x2))
-                y_min = int(min(y1, y2))
-                y_max = int(max(y1, y2))
-                
-                poly = [x1, y1, x2, y1, x2, y2, x1, y2]
-                
-                # cat_id = 1 if label["label"] == "Y" else 0
-                cat_id = 0
-            
-                data_anno = dict(
-                    image_id=i,
-                    id=obj_count,
-                    category_id=cat_id,
-                    bbox=[x_min, y_min, x_max - x_min, y_max - y_min],
-                    area=(x_max - x_min) * (y_max - y_min),
-                    segmentation=[poly],
-                    iscrowd=0)
-                annotations.append(data_anno)
-                obj_count += 1
+def update_coco_split(out_file, split, fresh, changed, stale, num_workers=None, index=True):
+    coco_file = os.path.join(out_file, f"annotation_coco_{split}.json")
+    categories = [{
+        'id': 0,
+        'name': 'ROI'
+    }]
 
-        coco_format_json = dict(
-            images=images,
-            annotations=annotations,
-            categories=[{
-                'id': 0,
-                'name': 'ROI'
-            }])
-        
-        with open(os.path.join(out_file, f"annotation_coco_{split}.json"), "w", encoding='utf-8') as f:
-            json.dump(coco_format_json, f, indent=4, ensure_ascii=False)
+    # 删除旧的图像和标注；增量更新时保留的记录通过.idx从已有的json中逐条读取
+    stale_ids = set(record["id"] for record in stale)
+    for record in stale :
+        if os.path.exists(os.path.join(out_file, split, record["key"])) :
+            os.remove(os.path.join(out_file, split, record["key"]))
+    source, kept_ids = None, []
+    if not fresh :
+        source = CocoIndex(coco_file)
+        kept_ids = sorted(image_id for image_id in source.image_ids if image_id not in stale_ids)
+    obj_count = source.max_annotation_id(kept_ids) + 1 if source is not None else 0
+
+    # 复制图像、读取尺寸和标注在进程池中完成，结果按图像编号顺序逐个写入文件
+    changed = sorted(changed, key=lambda item: item["id"])
+    jobs = [(item["paths"][0], item["paths"][1], os.path.join(out_file, split, item["key"])) for item in changed]
+    new_images = zip(changed, iter_jobs(copy_labelme_pair, jobs, num_workers))
+
+    with CocoWriter(coco_file, categories, index=index) as writer :
+        for entry in heapq.merge(((image_id, 0, None) for image_id in kept_ids),
+                                 ((item["id"], 1, (item, result)) for item, result in new_images),
+                                 key=lambda entry: entry[:2]) :
+            if entry[1] == 0 :
+                writer.add(source.image(entry[0]), source.annotations(entry[0]))
+                continue
+            item, (height, width, shapes) = entry[2]
+            annotations = coco_annotations(item["id"], shapes, obj_count)
+            obj_count += len(annotations)
+            writer.add(dict(id=item["id"], file_name=item["key"], height=height, width=width), annotations)
+    if source is not None :
+        source.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,57 @@
+import os
+import io
+import json
+import tarfile
+
+
+def pack_split(split_dir, out_dir, shard_size=256 * 1024 * 1024):
+    # 把一个split（如train/fold1）下按类别存放的小jpg打包成若干个顺序读取的tar分片
+    # 类别索引与Classification/utils.py中read_dataset一致：类别文件夹名排序
+    split = os.path.split(os.path.normpath(split_dir))[-1]
+    classes = sorted(item.name for item in os.scandir(split_dir) if item.is_dir())
+    supported = [".jpg", ".JPG", ".png", ".PNG"]
+
+    samples = []
+    for label, cla in enumerate(classes):
+        names = sorted(i for i in os.listdir(os.path.join(split_dir, cla)) if os.path.splitext(i)[-1] in supported)
+        samples += [(os.path.join(split_dir, cla, name), f"{cla}/{name}", label) for name in names]
+
+    os.makedirs(out_dir, exist_ok=True)
+    shards = []
+    tar = None
+    shard_bytes = 0
+    for src, name, label in samples:
+        if tar is None or shard_bytes >= shard_size:
+            if tar is not None:
+                tar.close()
+            shard_name = f"{split}-{len(shards):05d}.tar"
+            tar = tarfile.open(os.path.join(out_dir, shard_name), "w")
+            shards.append({"file": shard_name, "samples": []})
+            shard_bytes = 0
+        with open(src, "rb") as f:
+            data = f.read()
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+        shards[-1]["samples"].append([name, label])
+        shard_bytes += len(data)
+    if tar is not None:
+        tar.close()
+
+    index = {"split": split, "classes": classes, "num_samples": len(samples), "shards": shards}
+    with open(os.path.join(out_dir, f"{split}.json"), "w") as f:
+        json.dump(index, f)
+    print(f"{split}: {len(samples)} images packed into {len(shards)} shards")
+    return index
+
+
+def pack_dataset(dataset_dir, out_dir, shard_size=256 * 1024 * 1024):
+    splits = sorted(item.name for item in os.scandir(dataset_dir) if item.is_dir())
+    for split in splits:
+        pack_split(os.path.join(dataset_dir, split), out_dir, shard_size)
+
+
+if __name__ == '__main__':
+
+    pack_dataset(dataset_dir='data/dataset/Task1_crop_balanced',
+                 out_dir='data/dataset/Task1_crop_balanced_shards')